@@ -0,0 +1,7 @@
+"""
+Benchmarks for measuring metags performance across versions.
+
+Run the suite with::
+
+    python -m metags.benchmarks --output results.json
+"""
@@ -0,0 +1,187 @@
+"""
+Deterministic synthetic catalogs for benchmarking.
+"""
+import os
+import math
+import random
+import attr
+
+from typing import TYPE_CHECKING, Dict, List, Tuple
+
+
+if TYPE_CHECKING:
+    import metags.core
+
+
+SIZE_DISTRIBUTIONS = ('constant', 'uniform', 'lognormal')
+
+
+@attr.s
+class SyntheticCatalog(object):
+    """
+    Reproducible file tree and metadata generator.
+
+    The same parameters and seed always produce the same tree, file contents
+    and tags so results are comparable between runs.
+    """
+    file_count = attr.ib(default=1000)
+    depth = attr.ib(default=3)
+    fanout = attr.ib(default=4)
+    mean_size = attr.ib(default=4096)
+    max_size = attr.ib(default=2 ** 20)
+    size_distribution = attr.ib(default='lognormal')
+    tag_keys = attr.ib(default=3)
+    tag_cardinality = attr.ib(default=50)
+    tags_per_key = attr.ib(default=2)
+    duplicate_ratio = attr.ib(default=0.0)
+    seed = attr.ib(default=0)
+
+    @size_distribution.validator
+    def _check_size_distribution(self, attribute, value):
+        if value not in SIZE_DISTRIBUTIONS:
+            raise ValueError('Unknown size distribution {!r}. Expected one '
+                             'of {}'.format(value, SIZE_DISTRIBUTIONS))
+
+    def _rng(self, *salt):
+        return random.Random('{}:{}'.format(
+            self.seed, ':'.join(str(x) for x in salt)))
+
+    def _size(self, rng):
+        if self.size_distribution == 'constant':
+            size = self.mean_size
+        elif self.size_distribution == 'uniform':
+            size = rng.randint(0, 2 * self.mean_size)
+        else:
+            sigma = 1.0
+            mu = math.log(max(self.mean_size, 1)) - sigma ** 2 / 2
+            size = int(rng.lognormvariate(mu, sigma))
+        return min(size, self.max_size)
+
+    def directories(self):
+        """
+        Relative directory paths making up the tree.
+
+        Returns
+        -------
+        List[str]
+        """
+        dirs = ['']
+        level = ['']
+        for depth in range(self.depth):
+            level = [os.path.join(parent, 'd{}_{}'.format(depth, i))
+                     for parent in level for i in range(self.fanout)]
+            dirs.extend(level)
+        return dirs
+
+    def files(self):
+        """
+        Relative file paths along with their size and content seed.
+
+        Files sharing a content seed have identical content.
+
+        Returns
+        -------
+        List[Tuple[str, int, int]]
+        """
+        rng = self._rng('files')
+        dirs = self.directories()
+        results = []
+        for i in range(self.file_count):
+            if results and rng.random() < self.duplicate_ratio:
+                _, size, content = rng.choice(results)
+            else:
+                size, content = self._size(rng), i
+            relpath = os.path.join(rng.choice(dirs), 'f{:08d}.dat'.format(i))
+            results.append((relpath, size, content))
+        return results
+
+    def content(self, size, content):
+        """
+        Deterministic file content.
+
+        Content is kept as text since `metags.utils.createC4hash` reads files
+        in text mode.
+
+        Parameters
+        ----------
+        size : int
+        content : int
+            Content seed.
+
+        Returns
+        -------
+        str
+        """
+        if not size:
+            return ''
+        rng = self._rng('content', content)
+        return '{:0{}x}'.format(rng.getrandbits(size * 4), size)
+
+    def metadata(self, relpath):
+        """
+        Deterministic metadata for a file.
+
+        Parameters
+        ----------
+        relpath : str
+
+        Returns
+        -------
+        Dict[str, List[str]]
+        """
+        rng = self._rng('metadata', relpath)
+        values = range(self.tag_cardinality)
+        count = min(self.tags_per_key, self.tag_cardinality)
+        return dict(
+            ('tag{}'.format(k), ['value{}'.format(v)
+                                 for v in rng.sample(values, count)])
+            for k in range(self.tag_keys))
+
+    def write(self, root):
+        """
+        Write the file tree to disk.
+
+        Parameters
+        ----------
+        root : str
+
+        Returns
+        -------
+        List[str]
+            Absolute paths of the written files.
+        """
+        root = os.path.realpath(root)
+        for relpath in self.directories():
+            path = os.path.join(root, relpath)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        results = []
+        for relpath, size, content in self.files():
+            path = os.path.join(root, relpath)
+            with open(path, 'w') as f:
+                f.write(self.content(size, content))
+            results.append(path)
+        return results
+
+    def items(self, root):
+        """
+        Items, with c4 ids and metadata, for a tree written to `root`.
+
+        Parameters
+        ----------
+        root : str
+
+        Returns
+        -------
+        List[metags.core.Item]
+        """
+        import metags.core
+        import metags.utils
+        root = os.path.realpath(root)
+        results = []
+        for relpath, _, _ in self.files():
+            path = os.path.join(root, relpath)
+            results.append(metags.core.Item(
+                url=path, c4=metags.utils.c4hash(path),
+                metadata=self.metadata(relpath)))
+        return results
@@ -0,0 +1,136 @@
+"""
+Import-time budgets for short-lived processes.
+
+Each module is imported in a fresh interpreter with ``python -X importtime``
+and checked against a time budget and a list of heavy modules it must not
+pull in. Run the check with::
+
+    python -m metags.benchmarks.imports
+"""
+from __future__ import print_function
+import sys
+import subprocess
+
+from typing import Dict, List, Optional, Tuple
+
+
+# Cumulative import time budgets in seconds.
+BUDGETS = {
+    'metags.core': 0.1,
+    'metags.factory': 0.1,
+    'metags.storage.memory': 0.1,
+    'metags.storage.database': 0.1,
+}
+
+# Modules which must only be imported on first use.
+FORBIDDEN = {
+    'metags.core': ('sqlalchemy', 'kids', 'hashlib', 'metags.events'),
+    'metags.factory': ('sqlalchemy', 'hashlib', 'asyncio'),
+    'metags.storage.memory': ('sqlalchemy', 'hashlib'),
+    'metags.storage.database': ('sqlalchemy', 'hashlib'),
+}
+
+
+def importtime(module):
+    """
+    Import `module` in a fresh interpreter and report what it cost.
+
+    Parameters
+    ----------
+    module : str
+
+    Returns
+    -------
+    Tuple[float, List[str]]
+        Cumulative seconds spent importing `module` (including its parent
+        packages) and the names of all modules imported along the way.
+    """
+    output = subprocess.check_output(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        stderr=subprocess.STDOUT, universal_newlines=True)
+
+    seconds = 0.0
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        _, cumulative, name = line.split('|')
+        if not cumulative.strip().isdigit():
+            # header
+            continue
+        stripped = name.strip()
+        modules.append(stripped)
+        toplevel = len(name) - len(name.lstrip()) <= 1
+        if toplevel and (stripped == module or
+                         module.startswith(stripped + '.')):
+            seconds += int(cumulative) / 1e6
+    return seconds, modules
+
+
+def bench_imports(budgets=None):
+    """
+    Time importing each module in `budgets`.
+
+    Parameters
+    ----------
+    budgets : Optional[Dict[str, float]]
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+    """
+    results = []
+    for module in sorted(budgets or BUDGETS):
+        seconds, _ = importtime(module)
+        results.append(dict(name='import.' + module, engine=None,
+                            seconds=seconds, ops=1, per_op=seconds))
+    return results
+
+
+def check(budgets=None, forbidden=None):
+    """
+    Find modules which exceed their import budget or import heavy modules.
+
+    Parameters
+    ----------
+    budgets : Optional[Dict[str, float]]
+    forbidden : Optional[Dict[str, Tuple[str, ...]]]
+
+    Returns
+    -------
+    List[str]
+        Descriptions of each failure.
+    """
+    budgets = BUDGETS if budgets is None else budgets
+    forbidden = FORBIDDEN if forbidden is None else forbidden
+
+    failures = []
+    for module in sorted(set(budgets) | set(forbidden)):
+        seconds, modules = importtime(module)
+        budget = budgets.get(module)
+        if budget is not None and seconds > budget:
+            failures.append('{} took {:.3f}s to import (budget {:.3f}s)'
+                            .format(module, seconds, budget))
+        for heavy in forbidden.get(module, ()):
+            if any(x == heavy or x.startswith(heavy + '.') for x in modules):
+                failures.append('{} imports {}'.format(module, heavy))
+    return failures
+
+
+def main():
+    """
+    Command line entry point.
+
+    Returns
+    -------
+    int
+        Exit code. Non-zero if any budget was exceeded.
+    """
+    failures = check()
+    for failure in failures:
+        print(failure)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,322 @@
+"""
+Benchmark suite timing hashing, walking, ingest and queries.
+"""
+from __future__ import print_function
+import os
+import json
+import random
+import timeit
+import attr
+import metags
+import metags.utils
+import metags.factory
+from metags.benchmarks.catalog import SyntheticCatalog
+from metags.benchmarks.imports import bench_imports
+
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional
+
+
+if TYPE_CHECKING:
+    import metags.core
+    import metags.storage.base
+
+
+def _memory_engine(db):
+    import metags.storage.memory
+    return metags.storage.memory.MemoryStorageEngine()
+
+
+def _database_engine(db):
+    import metags.storage.database
+    return metags.storage.database.DatabaseStorageEngine(db)
+
+
+def _tiered_engine(db):
+    import metags.storage.tiered
+    return metags.storage.tiered.TieredStorageEngine(_database_engine(db))
+
+
+# Storage engine constructors by name. Each is passed the database url.
+ENGINES = {
+    'memory': _memory_engine,
+    'database': _database_engine,
+    'tiered': _tiered_engine,
+}
+
+
+def _result(name, seconds, ops, engine=None, **extra):
+    result = dict(name=name, engine=engine, seconds=seconds, ops=ops,
+                  per_op=seconds / ops if ops else None)
+    result.update(extra)
+    return result
+
+
+def _timed(func, *args, **kwargs):
+    start = timeit.default_timer()
+    func(*args, **kwargs)
+    return timeit.default_timer() - start
+
+
+def bench_hashing(paths):
+    """
+    Time calculating c4 ids for `paths` with a cold cache.
+
+    Parameters
+    ----------
+    paths : List[str]
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+    """
+    metags.utils.createC4digest.cache_clear()
+    seconds = _timed(lambda: [metags.utils.c4hash(x) for x in paths])
+    size = sum(os.path.getsize(x) for x in paths)
+    return [_result('hash', seconds, len(paths), bytes=size)]
+
+
+def bench_walking(root):
+    """
+    Time the `FilepathFactory` generators over `root` with a cold cache.
+
+    Parameters
+    ----------
+    root : str
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+    """
+    factory = metags.factory.FilepathFactory(None)
+    results = []
+    for name in ('generate_syncronously', 'generate_asyncronously'):
+        generate = getattr(factory, name, None)
+        if generate is None:
+            continue
+        metags.utils.createC4digest.cache_clear()
+        found = []
+        seconds = _timed(lambda: found.extend(generate(root)))
+        results.append(_result('walk.' + name, seconds, len(found)))
+    return results
+
+
+def bench_ingest(engine, items, name=None):
+    """
+    Time adding `items` to `engine`.
+
+    Parameters
+    ----------
+    engine : metags.storage.base.AbstractStorageEngine
+    items : List[metags.core.Item]
+    name : Optional[str]
+        Engine name to record with the results.
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+    """
+    def add():
+        for item in items:
+            engine.add(item)
+    return [_result('ingest', _timed(add), len(items), engine=name)]
+
+
+def bench_queries(engine, items, queries=100, seed=0, name=None):
+    """
+    Time `get` lookups against an already populated `engine`.
+
+    Parameters
+    ----------
+    engine : metags.storage.base.AbstractStorageEngine
+    items : List[metags.core.Item]
+        Items stored on the engine to draw lookups from.
+    queries : int
+        Number of lookups per query type.
+    seed : int
+    name : Optional[str]
+        Engine name to record with the results.
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+    """
+    rng = random.Random(seed)
+    sample = [rng.choice(items) for _ in range(queries)]
+
+    def metadata(item):
+        key = sorted(item.metadata)[0]
+        return {key: item.metadata[key][0]}
+
+    lookups = [
+        ('query.c4', lambda x: dict(c4=x.c4)),
+        ('query.url', lambda x: dict(url=x.url)),
+        ('query.metadata', metadata),
+        ('query.c4_wildcard', lambda x: dict(c4=x.c4[:8] + '*')),
+        ('query.url_wildcard',
+         lambda x: dict(url='*' + os.path.basename(x.url))),
+    ]
+
+    results = []
+    for query, kwargs in lookups:
+        calls = [kwargs(x) for x in sample if x.metadata or
+                 query != 'query.metadata']
+        latencies = []
+        for call in calls:
+            latencies.append(_timed(engine.get, **call))
+        latencies.sort()
+        results.append(_result(
+            query, sum(latencies), len(latencies), engine=name,
+            p50=latencies[len(latencies) // 2] if latencies else None,
+            p99=latencies[int(len(latencies) * 0.99)] if latencies else None))
+
+    results.append(_result(
+        'query.duplicates', _timed(engine.duplicates), 1, engine=name))
+    return results
+
+
+def run(catalog, root, engines=None, db='sqlite://', queries=100):
+    """
+    Run the full suite against a catalog.
+
+    Parameters
+    ----------
+    catalog : SyntheticCatalog
+    root : str
+        Directory to write the catalog's file tree to.
+    engines : Optional[List[str]]
+        Names of `ENGINES` to benchmark. Defaults to all of them.
+    db : str
+        Database url for engines that use one.
+    queries : int
+        Number of lookups per query type.
+
+    Returns
+    -------
+    Dict[str, Any]
+    """
+    import time
+    import platform
+
+    paths = catalog.write(root)
+
+    results = []
+    results.extend(bench_imports())
+    results.extend(bench_hashing(paths))
+    results.extend(bench_walking(root))
+
+    for name in engines or sorted(ENGINES):
+        engine = ENGINES[name](db)
+        items = catalog.items(root)
+        results.extend(bench_ingest(engine, items, name=name))
+        results.extend(bench_queries(
+            engine, items, queries=queries, seed=catalog.seed, name=name))
+
+    return dict(
+        version=metags.__version__,
+        python=platform.python_version(),
+        platform=platform.platform(),
+        created=time.time(),
+        catalog=attr.asdict(catalog),
+        results=results,
+    )
+
+
+def compare(baseline, current, tolerance=0.1):
+    """
+    Find benchmarks which got slower between two runs.
+
+    Parameters
+    ----------
+    baseline : Dict[str, Any]
+    current : Dict[str, Any]
+        Results as returned by `run`.
+    tolerance : float
+        Fraction a benchmark may slow down by before it's a regression.
+
+    Returns
+    -------
+    List[Dict[str, Any]]
+    """
+    def key(result):
+        return result['name'], result['engine']
+
+    before = dict((key(x), x) for x in baseline['results'])
+    regressions = []
+    for result in current['results']:
+        previous = before.get(key(result))
+        if not previous or not previous['per_op'] or not result['per_op']:
+            continue
+        ratio = result['per_op'] / previous['per_op']
+        if ratio > 1 + tolerance:
+            regressions.append(dict(
+                name=result['name'], engine=result['engine'],
+                baseline=previous['per_op'], current=result['per_op'],
+                ratio=ratio))
+    return regressions
+
+
+def main(argv=None):
+    """
+    Command line entry point.
+
+    Parameters
+    ----------
+    argv : Optional[List[str]]
+
+    Returns
+    -------
+    int
+        Exit code. Non-zero if regressions were found.
+    """
+    import shutil
+    import argparse
+    import tempfile
+
+    defaults = SyntheticCatalog()
+    parser = argparse.ArgumentParser(description=__doc__)
+    for field in attr.fields(SyntheticCatalog):
+        parser.add_argument(
+            '--' + field.name.replace('_', '-'), dest=field.name,
+            type=type(getattr(defaults, field.name)),
+            default=getattr(defaults, field.name))
+    parser.add_argument('--engine', dest='engines', action='append',
+                        choices=sorted(ENGINES))
+    parser.add_argument('--db', default='sqlite://')
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--root', help='Directory to write the file tree to. '
+                                       'Defaults to a temporary directory.')
+    parser.add_argument('--output', help='Filepath to write results to.')
+    parser.add_argument('--compare', help='Filepath of baseline results.')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args(argv)
+
+    catalog = SyntheticCatalog(**dict(
+        (x.name, getattr(args, x.name))
+        for x in attr.fields(SyntheticCatalog)))
+
+    root = args.root or tempfile.mkdtemp(prefix='metags_bench_')
+    try:
+        results = run(catalog, root, engines=args.engines, db=args.db,
+                      queries=args.queries)
+    finally:
+        if not args.root:
+            shutil.rmtree(root)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    for result in results['results']:
+        print('{:<32} {:<10} {:>8} ops {:>12.6f}s'.format(
+            result['name'], result['engine'] or '-', result['ops'],
+            result['seconds']))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, results, tolerance=args.tolerance)
+        for x in regressions:
+            print('REGRESSION {name} ({engine}): {ratio:.2f}x slower'.format(
+                **x))
+        return 1 if regressions else 0
+    return 0
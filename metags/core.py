@@ -1,8 +1,6 @@
 import six
 import collections
 import attr
-import metags.utils
-import metags.events
 
 from typing import Dict, Optional, Any
 
@@ -39,4 +37,5 @@ class Item(object):
         -------
         str
         """
+        import metags.utils
         return metags.utils.c4hash(self.url)
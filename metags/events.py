@@ -4,9 +4,9 @@ Simple in-process event system.
 TODO: upgrade this event system
 """
 import functools
-from kids.cache import undecorate, SUPPORTED_DECORATOR
+import metags.metrics
 
-from typing import Callable, Union
+from typing import Any, Callable, Union
 
 
 # Cache of events being listened for. This is populated by the `listen`
@@ -14,6 +14,33 @@ from typing import Callable, Union
 _events = {}
 
 
+def _listener_name(func):
+    return '{}.{}'.format(
+        func.__module__, getattr(func, '__qualname__', func.__name__))
+
+
+def emit(name, result):
+    """
+    Send a result to the listeners of an event, as if it was returned by a
+    function decorated with `event`.
+
+    Parameters
+    ----------
+    name : str
+    result : Any
+    """
+    listeners = _events.get(name, [])
+    if not metags.metrics.enabled():
+        for e in listeners:
+            e(result)
+        return
+    for e in listeners:
+        with metags.metrics.timer(
+                metags.metrics.EVENT_LISTENER_SECONDS,
+                event=name, listener=_listener_name(e)):
+            e(result)
+
+
 def event(name_or_func):
     """
     Decorator for easily sending the results of the decorated function to any
@@ -27,6 +54,8 @@ def event(name_or_func):
     -------
     Callable
     """
+    from kids.cache import undecorate, SUPPORTED_DECORATOR
+
     def decorator(func):
 
         wrapper, wrapped = undecorate(func)
@@ -34,10 +63,7 @@ def event(name_or_func):
         @functools.wraps(wrapped)
         def wrap(*args, **kwargs):
             result = wrapped(*args, **kwargs)
-
-            for e in _events.get(eventname, []):
-                e(result)
-
+            emit(eventname, result)
             return result
 
         return wrapper(wrap)
@@ -69,6 +95,8 @@ def listen(name, highlander=False, singleton=False):
     -------
     Callable
     """
+    from kids.cache import undecorate
+
     def decorator(func):
 
         listeners = _events.get(name, [])
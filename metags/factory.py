@@ -1,10 +1,10 @@
 """
 Factories are helpers for populating items on a storage engine.
 """
-from __future__ import print_function
 import os
 import six
 import metags.core
+import metags.metrics
 from metags.utils import tracktime
 
 
@@ -36,15 +36,19 @@ class FilepathFactory(AbstractFactory):
         """
         import datetime
         import metags.utils
-        filepath = os.path.realpath(filepath)
-        assert os.path.isfile(filepath), 'Only existing files are valid.'
-        statinfo = os.stat(filepath)
+        with metags.metrics.stage('stat'):
+            filepath = os.path.realpath(filepath)
+            assert os.path.isfile(filepath), 'Only existing files are valid.'
+            statinfo = os.stat(filepath)
         metadata = metadata or {}
         metadata['st_mtime'] = [datetime.datetime.fromtimestamp(
             statinfo.st_mtime)]
         metadata['st_size'] = [statinfo.st_size]
-        c4id = metags.utils.createC4hash(
-            filepath, st_size=statinfo.st_size, st_mtime=statinfo.st_mtime)
+        with metags.metrics.stage('hash'):
+            c4id = metags.utils.createC4hash(
+                filepath, st_size=statinfo.st_size,
+                st_mtime=statinfo.st_mtime)
+        metags.metrics.counter(metags.metrics.FILES_TOTAL).inc()
         return metags.core.Item(url=filepath, c4=c4id, metadata=metadata)
 
     @tracktime
@@ -55,33 +59,28 @@ class FilepathFactory(AbstractFactory):
         Parameters
         ----------
         filepath : str
-        pattern : Union[str, _sre.SRE_Pattern]
+        pattern : Union[str, _sre.SRE_Pattern, metags.rules.Rules]
 
         Returns
         -------
         List[metags.core.Item]
         """
-        import re
+        import metags.rules
 
-        if pattern and isinstance(pattern, six.string_types):
-            pattern = re.compile(pattern)
+        rules = metags.rules.as_rules(pattern)
 
         filepath = os.path.realpath(filepath)
 
         results = []
 
         def walk(path):
-            for x in os.listdir(path):
-                x = os.path.join(path, x)
-                if os.path.isdir(x):
-                    for f in walk(x):
-                        yield f
-                else:
-                    if pattern:
-                        if pattern.match(x):
-                            yield x
-                    else:
-                        yield x
+            with metags.metrics.stage('walk'):
+                dirs, files = rules.scan(path)
+            for x in files:
+                yield x
+            for x in dirs:
+                for f in walk(x):
+                    yield f
 
         for path in walk(filepath):
             results.append(self.from_filepath(path))
@@ -100,62 +99,113 @@ class FilepathFactory(AbstractFactory):
             Parameters
             ----------
             filepath : str
-            pattern : Union[str, _sre.SRE_Pattern]
+            pattern : Union[str, _sre.SRE_Pattern, metags.rules.Rules]
 
             Returns
             -------
             List[metags.core.Item]
             """
             import os
-            import re
             import asyncio
+            import metags.rules
 
             results = []
 
-            if pattern and isinstance(pattern, six.string_types):
-                pattern = re.compile(pattern)
+            rules = metags.rules.as_rules(pattern)
 
             dirqueue = asyncio.Queue()
             filequeue = asyncio.Queue()
 
-            @asyncio.coroutine
-            def async_walk(q):
-                while not q.empty():
-                    path = yield from q.get()
-                    for x in os.scandir(path):
-                        if x.is_dir():
-                            q.put_nowait(x.path)
-                        else:
-                            if pattern:
-                                if pattern.match(x.path):
-                                    filequeue.put_nowait(x.path)
-                            else:
-                                filequeue.put_nowait(x.path)
-                    yield from asyncio.sleep(0)
-
-            @asyncio.coroutine
-            def async_from_filepath(q):
+            async def async_walk(q):
                 while not q.empty():
-                    path = yield from q.get()
-                    print('[{}] {}'.format(q.qsize(), path))
+                    path = await q.get()
+                    with metags.metrics.stage('walk'):
+                        dirs, files = rules.scan(path)
+                    for x in dirs:
+                        q.put_nowait(x)
+                    for x in files:
+                        filequeue.put_nowait(x)
+                    await asyncio.sleep(0)
+                # signal the end of the walk
+                filequeue.put_nowait(None)
+
+            async def async_from_filepath(q):
+                while True:
+                    path = await q.get()
+                    if path is None:
+                        break
                     results.append(self.from_filepath(path))
-                    yield from asyncio.sleep(0)
-
-            dirqueue.put_nowait(filepath)
-            loop = asyncio.get_event_loop()
+                    await asyncio.sleep(0)
 
-            tasks = [
-                asyncio.Task(async_walk(dirqueue)),
-                asyncio.Task(async_from_filepath(filequeue)),
-            ]
+            async def main():
+                await asyncio.gather(
+                    async_walk(dirqueue),
+                    async_from_filepath(filequeue),
+                )
 
-            loop.run_until_complete(asyncio.wait(tasks))
-            # loop.close()
+            dirqueue.put_nowait(filepath)
+            loop = asyncio.new_event_loop()
+            try:
+                loop.run_until_complete(main())
+            finally:
+                loop.close()
 
             return results
 
         generate = generate_asyncronously
 
+    def watch(self, filepath, pattern=None, **kwargs):
+        """
+        Watch a filepath, keeping the storage registry in sync with changes
+        made below it.
+
+        Call `run` on the result to start applying changes.
+
+        Parameters
+        ----------
+        filepath : str
+        pattern : Union[str, _sre.SRE_Pattern, metags.rules.Rules]
+        kwargs : Dict
+            See `metags.watcher.Watcher`.
+
+        Returns
+        -------
+        metags.watcher.Watcher
+        """
+        import metags.watcher
+        return metags.watcher.Watcher(
+            self, filepath, pattern=pattern, **kwargs)
+
+    def ingest(self, filepath, journal, pattern=None, batch_size=1000):
+        """
+        Add a filepath to the storage registry, recording progress in a
+        journal so an interrupted ingest can be resumed by calling this
+        again with the same journal.
+
+        Assumes no other process is ingesting with the same journal. See
+        `metags.ingest` for sharing the work between processes.
+
+        Parameters
+        ----------
+        filepath : str
+        journal : Union[str, metags.ingest.Journal]
+            Journal or its filepath.
+        pattern : Union[str, _sre.SRE_Pattern, metags.rules.Rules]
+        batch_size : int
+            Number of items written to storage per transaction.
+
+        Returns
+        -------
+        int
+            Number of files written.
+        """
+        import metags.ingest
+        ingest = metags.ingest.Ingest(
+            self, journal, pattern=pattern, batch_size=batch_size)
+        # claims left over from an interrupted run
+        ingest.journal.release()
+        return ingest.run(filepath)
+
     def add(self, filepath, pattern=None):
         """
         Add a filepath to the storage registry. Recurses into any directories
@@ -164,7 +214,7 @@ class FilepathFactory(AbstractFactory):
         Parameters
         ----------
         filepath : str
-        pattern : Union[str, _sre.SRE_Pattern]
+        pattern : Union[str, _sre.SRE_Pattern, metags.rules.Rules]
         """
         for item in self.generate(filepath, pattern=pattern):
             self.storage.add(item)
@@ -0,0 +1,442 @@
+"""
+Resumable, journaled ingest of large trees.
+
+The tree is split into work units, one per directory. A journal records
+which units are pending, claimed or done, along with the files already
+written for units in progress. Items are written in batches and recorded
+in the journal after each batch, so an interrupted ingest resumes without
+re-walking finished directories or re-hashing written files.
+
+Several local processes can share a journal, each claiming units as they
+go::
+
+    python -m metags.ingest /mnt/share --journal ingest.journal \\
+        --db sqlite:///metags.db --processes 8
+"""
+from __future__ import print_function
+import os
+import time
+import socket
+import contextlib
+import six
+import metags.metrics
+
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Set, Union
+
+
+if TYPE_CHECKING:
+    import sqlite3
+    import metags.factory
+
+
+PENDING = 'pending'
+CLAIMED = 'claimed'
+DONE = 'done'
+
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS units ('
+    '    path TEXT PRIMARY KEY,'
+    '    state TEXT NOT NULL,'
+    '    owner TEXT,'
+    '    claimed_at REAL)',
+    'CREATE INDEX IF NOT EXISTS units_state ON units (state)',
+    'CREATE TABLE IF NOT EXISTS files ('
+    '    unit TEXT NOT NULL,'
+    '    path TEXT NOT NULL,'
+    '    PRIMARY KEY (unit, path))',
+)
+
+
+class Journal(object):
+    """
+    Sqlite backed record of ingest progress, safe to share between
+    processes.
+    """
+    def __init__(self, path, timeout=60.0):
+        """
+        Parameters
+        ----------
+        path : str
+            Journal filepath.
+        timeout : float
+            Seconds to wait for other processes to release the journal.
+        """
+        import sqlite3
+        self.path = path
+        self._conn = sqlite3.connect(
+            path, timeout=timeout, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        with self._transaction() as conn:
+            for statement in _SCHEMA:
+                conn.execute(statement)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """
+        Returns
+        -------
+        Iterator[sqlite3.Connection]
+        """
+        self._conn.execute('BEGIN IMMEDIATE')
+        try:
+            yield self._conn
+        except Exception:
+            self._conn.execute('ROLLBACK')
+            raise
+        else:
+            self._conn.execute('COMMIT')
+
+    def close(self):
+        self._conn.close()
+
+    def seed(self, root):
+        """
+        Add the root of the tree as the first unit of work. Does nothing if
+        it was already added.
+
+        Parameters
+        ----------
+        root : str
+        """
+        self.discover([root])
+
+    def discover(self, paths):
+        """
+        Add directories as pending units of work, ignoring known ones.
+
+        Parameters
+        ----------
+        paths : List[str]
+        """
+        if not paths:
+            return
+        with self._transaction() as conn:
+            conn.executemany(
+                'INSERT OR IGNORE INTO units (path, state) VALUES (?, ?)',
+                [(x, PENDING) for x in paths])
+
+    def release(self, owner=None):
+        """
+        Return claimed units to pending.
+
+        Parameters
+        ----------
+        owner : Optional[str]
+            Only release units claimed by this owner. By default all claims
+            are released, which is only safe when no workers are running.
+        """
+        query = 'UPDATE units SET state = ?, owner = NULL WHERE state = ?'
+        args = [PENDING, CLAIMED]
+        if owner is not None:
+            query += ' AND owner = ?'
+            args.append(owner)
+        with self._transaction() as conn:
+            conn.execute(query, args)
+
+    def claim(self, owner, stale=600.0):
+        """
+        Claim the next unit of work.
+
+        Parameters
+        ----------
+        owner : str
+        stale : float
+            Seconds after which a claimed unit which hasn't made progress is
+            considered abandoned and can be claimed again.
+
+        Returns
+        -------
+        Optional[str]
+            Directory to ingest, or None if no unit is available.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                'SELECT path FROM units WHERE state = ? OR '
+                '(state = ? AND claimed_at < ?) ORDER BY rowid LIMIT 1',
+                (PENDING, CLAIMED, now - stale)).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                'UPDATE units SET state = ?, owner = ?, claimed_at = ? '
+                'WHERE path = ?', (CLAIMED, owner, now, row[0]))
+        return row[0]
+
+    def written(self, unit):
+        """
+        Files already written for a unit.
+
+        Parameters
+        ----------
+        unit : str
+
+        Returns
+        -------
+        Set[str]
+        """
+        return set(x for x, in self._conn.execute(
+            'SELECT path FROM files WHERE unit = ?', (unit,)))
+
+    def record(self, unit, paths):
+        """
+        Record files of a unit as written. This also marks the unit's claim
+        as still active.
+
+        Parameters
+        ----------
+        unit : str
+        paths : List[str]
+        """
+        with self._transaction() as conn:
+            conn.executemany(
+                'INSERT OR IGNORE INTO files (unit, path) VALUES (?, ?)',
+                [(unit, x) for x in paths])
+            conn.execute('UPDATE units SET claimed_at = ? WHERE path = ?',
+                         (time.time(), unit))
+
+    def complete(self, unit):
+        """
+        Mark a unit as done.
+
+        Parameters
+        ----------
+        unit : str
+        """
+        with self._transaction() as conn:
+            conn.execute(
+                'UPDATE units SET state = ?, owner = NULL WHERE path = ?',
+                (DONE, unit))
+            conn.execute('DELETE FROM files WHERE unit = ?', (unit,))
+
+    def progress(self):
+        """
+        Number of units in each state.
+
+        Returns
+        -------
+        Dict[str, int]
+        """
+        results = dict((x, 0) for x in (PENDING, CLAIMED, DONE))
+        results.update(self._conn.execute(
+            'SELECT state, COUNT(*) FROM units GROUP BY state'))
+        return results
+
+
+class Ingest(object):
+    """
+    Claims units of work from a journal and writes their files to storage.
+    """
+    def __init__(self, factory, journal, pattern=None, batch_size=1000,
+                 stale=600.0, owner=None, retries=5):
+        """
+        Parameters
+        ----------
+        factory : metags.factory.FilepathFactory
+        journal : Union[str, Journal]
+        pattern : Union[str, _sre.SRE_Pattern, metags.rules.Rules]
+        batch_size : int
+            Number of items written to storage per transaction.
+        stale : float
+            See `Journal.claim`.
+        owner : Optional[str]
+            Identifies this worker in the journal. Defaults to the host name
+            and process id.
+        retries : int
+            Times a batch is retried when the database is too busy to write
+            it.
+        """
+        import metags.rules
+        if isinstance(journal, six.string_types):
+            journal = Journal(journal)
+        self.factory = factory
+        self.storage = factory.storage
+        self.journal = journal
+        self.rules = metags.rules.as_rules(pattern)
+        self.batch_size = batch_size
+        self.stale = stale
+        self.owner = owner or '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.retries = retries
+
+    def run(self, filepath, poll=1.0):
+        """
+        Ingest a tree until no work is left.
+
+        Parameters
+        ----------
+        filepath : str
+        poll : float
+            Seconds to wait for other workers to discover more work.
+
+        Returns
+        -------
+        int
+            Number of files written by this worker.
+        """
+        self.journal.seed(os.path.realpath(filepath))
+        count = 0
+        while True:
+            unit = self.journal.claim(self.owner, stale=self.stale)
+            if unit is not None:
+                count += self.process(unit)
+                continue
+            if not self.journal.progress()[CLAIMED]:
+                return count
+            # other workers may still discover directories
+            time.sleep(poll)
+
+    def process(self, unit):
+        """
+        Write the files directly within a directory to storage.
+
+        Sub-directories are added to the journal as new units.
+
+        Parameters
+        ----------
+        unit : str
+
+        Returns
+        -------
+        int
+            Number of files written.
+        """
+        with metags.metrics.stage('walk'):
+            try:
+                dirs, files = self.rules.scan(unit)
+            except OSError:
+                dirs, files = [], []
+        self.journal.discover(dirs)
+
+        # paths are recorded as listed rather than as item urls, which
+        # resolve symlinks
+        written = self.journal.written(unit)
+        count = 0
+        paths = []
+        batch = []
+        for path in files:
+            if path in written:
+                continue
+            try:
+                batch.append(self.factory.from_filepath(path))
+            except (OSError, AssertionError):
+                # vanished since the directory was listed
+                continue
+            paths.append(path)
+            if len(batch) >= self.batch_size:
+                count += self._write(unit, batch, paths)
+                paths = []
+                batch = []
+        if batch:
+            count += self._write(unit, batch, paths)
+
+        self.journal.complete(unit)
+        return count
+
+    def _write(self, unit, items, paths):
+        add_many = getattr(self.storage, 'add_many', None)
+        for attempt in range(self.retries + 1):
+            try:
+                if add_many is not None:
+                    add_many(items)
+                else:
+                    for item in items:
+                        self.storage.add(item)
+            except Exception as e:
+                # e.g. sqlite's "database is locked" once its timeout runs
+                # out. The failed batch was rolled back, so it's retried
+                # whole.
+                if type(e).__name__ != 'OperationalError' or \
+                        attempt == self.retries:
+                    raise
+                time.sleep(min(2 ** attempt, 30))
+            else:
+                break
+        self.journal.record(unit, paths)
+        return len(items)
+
+
+def _worker(root, journal, db, pattern, batch_size):
+    import metags.factory
+    import metags.storage.database
+    storage = metags.storage.database.DatabaseStorageEngine(db)
+    factory = metags.factory.FilepathFactory(storage)
+    ingest = Ingest(factory, journal, pattern=pattern, batch_size=batch_size)
+    try:
+        ingest.run(root)
+    except BaseException:
+        # let the other workers pick up where this one stopped
+        ingest.journal.release(ingest.owner)
+        raise
+    finally:
+        storage.close()
+
+
+def main(argv=None):
+    """
+    Command line entry point.
+
+    Parameters
+    ----------
+    argv : Optional[List[str]]
+
+    Returns
+    -------
+    int
+        Exit code.
+    """
+    import argparse
+    import multiprocessing
+    import metags.rules
+    import metags.storage.database
+
+    parser = argparse.ArgumentParser(
+        description='Resumable ingest of a tree into database storage.')
+    parser.add_argument('root')
+    parser.add_argument('--journal', required=True)
+    parser.add_argument('--db', required=True, help='Database url.')
+    parser.add_argument('--processes', type=int, default=1)
+    parser.add_argument('--pattern',
+                        help='Only ingest files whose path matches.')
+    parser.add_argument('--exclude-dir', action='append', default=[],
+                        help='Skip directories matching this glob.')
+    parser.add_argument('--extension', action='append',
+                        help='Only ingest files with this extension.')
+    parser.add_argument('--batch-size', type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    rules = [metags.rules.exclude(x, directory=True)
+             for x in args.exclude_dir]
+    if args.pattern:
+        rules.append(metags.rules.include(args.pattern, regex=True))
+    rules = metags.rules.Rules(rules, default=not args.pattern,
+                               extensions=args.extension)
+
+    root = os.path.realpath(args.root)
+    journal = Journal(args.journal)
+    journal.seed(root)
+    # nothing else is running, so claims left over from a previous run are
+    # abandoned
+    journal.release()
+    # connecting creates the schema, which workers would otherwise race to do
+    storage = metags.storage.database.DatabaseStorageEngine(args.db)
+    storage.session
+    storage.close()
+
+    workers = [multiprocessing.Process(
+        target=_worker,
+        args=(root, args.journal, args.db, rules, args.batch_size))
+        for _ in range(args.processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    progress = journal.progress()
+    journal.close()
+    print('{done} done, {pending} pending, {claimed} claimed'.format(
+        **progress))
+    return 0 if all(x.exitcode == 0 for x in workers) else 1
+
+
+if __name__ == '__main__':
+    import sys
+    sys.exit(main())
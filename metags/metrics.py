@@ -0,0 +1,392 @@
+"""
+Lightweight in-process metrics.
+
+Metrics are disabled by default and every helper short-circuits to a shared
+no-op object while disabled, so instrumented code costs next to nothing
+unless metrics are switched on with `enable` or by setting the
+``METAGS_METRICS`` environment variable.
+
+Collected metrics can be exported as a json snapshot or in the Prometheus
+text exposition format.
+"""
+import os
+import bisect
+import functools
+import threading
+import timeit
+
+from typing import TYPE_CHECKING, Any, Callable, Dict, Optional, Tuple
+
+
+if TYPE_CHECKING:
+    import sqlalchemy.engine
+
+
+# Per-stage durations. Stages are `walk`, `stat`, `hash`, `meta_resolve` and
+# `insert`. Stages may nest, e.g. `meta_resolve` happens during `insert`.
+STAGE_SECONDS = 'metags_stage_seconds'
+FILES_TOTAL = 'metags_files_total'
+SQL_STATEMENTS_TOTAL = 'metags_sql_statements_total'
+SQL_SECONDS = 'metags_sql_seconds'
+EVENT_LISTENER_SECONDS = 'metags_event_listener_seconds'
+FUNCTION_SECONDS = 'metags_function_seconds'
+WATCH_CHANGES_TOTAL = 'metags_watch_changes_total'
+CACHE_REQUESTS_TOTAL = 'metags_cache_requests_total'
+
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5,
+                   1.0, 5.0, 10.0)
+
+_enabled = os.environ.get('METAGS_METRICS', '').lower() in ('1', 'true')
+_lock = threading.Lock()
+# Metrics keyed by (name, labels).
+_metrics = {}
+
+
+class Counter(object):
+    """
+    Monotonically increasing value.
+    """
+    kind = 'counter'
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        with _lock:
+            self.value += amount
+
+    def snapshot(self):
+        return {'value': self.value}
+
+
+class Histogram(object):
+    """
+    Distribution of observed values in cumulative buckets.
+    """
+    kind = 'histogram'
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def cumulative(self):
+        """
+        Returns
+        -------
+        List[Tuple[float, int]]
+            Upper bounds paired with the number of observations less than or
+            equal to them. The last bound is infinity.
+        """
+        total = 0
+        results = []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            results.append((bound, total))
+        return results
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': [['+Inf' if b == float('inf') else b, c]
+                        for b, c in self.cumulative()],
+        }
+
+
+class _Timer(object):
+    """
+    Context manager and decorator observing elapsed seconds on a histogram.
+    """
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = timeit.default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(timeit.default_timer() - self.start)
+
+
+class _Null(object):
+    """
+    Stands in for any metric or timer while metrics are disabled.
+    """
+    value = 0
+
+    def inc(self, amount=1):
+        pass
+
+    def observe(self, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+_NULL = _Null()
+
+
+def enable():
+    """
+    Start collecting metrics.
+    """
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    """
+    Stop collecting metrics. Already collected metrics are kept.
+    """
+    global _enabled
+    _enabled = False
+
+
+def enabled():
+    """
+    Returns
+    -------
+    bool
+    """
+    return _enabled
+
+
+def reset():
+    """
+    Discard all collected metrics.
+    """
+    with _lock:
+        _metrics.clear()
+
+
+def _get(cls, name, labels):
+    key = (name, tuple(sorted(labels.items())))
+    metric = _metrics.get(key)
+    if metric is None:
+        with _lock:
+            metric = _metrics.setdefault(key, cls())
+    return metric
+
+
+def counter(name, **labels):
+    """
+    Get a counter.
+
+    Parameters
+    ----------
+    name : str
+    labels : Dict[str, str]
+
+    Returns
+    -------
+    Counter
+    """
+    if not _enabled:
+        return _NULL
+    return _get(Counter, name, labels)
+
+
+def histogram(name, **labels):
+    """
+    Get a histogram.
+
+    Parameters
+    ----------
+    name : str
+    labels : Dict[str, str]
+
+    Returns
+    -------
+    Histogram
+    """
+    if not _enabled:
+        return _NULL
+    return _get(Histogram, name, labels)
+
+
+def timer(name, **labels):
+    """
+    Context manager recording the seconds spent within it on a histogram.
+
+    Parameters
+    ----------
+    name : str
+    labels : Dict[str, str]
+
+    Returns
+    -------
+    ContextManager
+    """
+    if not _enabled:
+        return _NULL
+    return _Timer(_get(Histogram, name, labels))
+
+
+def stage(name):
+    """
+    Context manager timing a pipeline stage.
+
+    Parameters
+    ----------
+    name : str
+        One of `walk`, `stat`, `hash`, `meta_resolve` or `insert`.
+
+    Returns
+    -------
+    ContextManager
+    """
+    if not _enabled:
+        return _NULL
+    return _Timer(_get(Histogram, STAGE_SECONDS, {'stage': name}))
+
+
+def timed(name, **labels):
+    """
+    Decorator recording the duration of each call on a histogram.
+
+    Parameters
+    ----------
+    name : str
+    labels : Dict[str, str]
+
+    Returns
+    -------
+    Callable
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def _wrap(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with timer(name, **labels):
+                return func(*args, **kwargs)
+        return _wrap
+    return decorator
+
+
+def instrument_engine(engine):
+    """
+    Count and time every SQL statement executed through a sqlalchemy engine.
+
+    Statements are labelled by their leading keyword (SELECT, INSERT, ...).
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+    """
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context,
+                              executemany):
+        if _enabled:
+            conn.info.setdefault('metags_sql_start', []).append(
+                timeit.default_timer())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context,
+                             executemany):
+        starts = conn.info.get('metags_sql_start')
+        if not starts:
+            return
+        elapsed = timeit.default_timer() - starts.pop()
+        if _enabled:
+            verb = statement.lstrip().split(None, 1)[0].upper() \
+                if statement.strip() else 'UNKNOWN'
+            _get(Counter, SQL_STATEMENTS_TOTAL, {'statement': verb}).inc()
+            _get(Histogram, SQL_SECONDS, {'statement': verb}).observe(elapsed)
+
+
+def snapshot():
+    """
+    Current value of all collected metrics.
+
+    Returns
+    -------
+    Dict[str, List[Dict[str, Any]]]
+        Metric samples keyed by metric name.
+    """
+    results = {}
+    with _lock:
+        items = sorted(_metrics.items(), key=lambda x: x[0])
+    for (name, labels), metric in items:
+        sample = {'type': metric.kind, 'labels': dict(labels)}
+        sample.update(metric.snapshot())
+        results.setdefault(name, []).append(sample)
+    return results
+
+
+def to_json(**kwargs):
+    """
+    Parameters
+    ----------
+    kwargs : Dict
+        Passed to `json.dumps`.
+
+    Returns
+    -------
+    str
+    """
+    import json
+    return json.dumps(snapshot(), sort_keys=True, **kwargs)
+
+
+def _format_labels(labels, **extra):
+    labels = list(labels) + sorted(extra.items())
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(
+        k, str(v).replace('\\', r'\\').replace('"', r'\"').replace(
+            '\n', r'\n')) for k, v in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def to_prometheus():
+    """
+    Collected metrics in the Prometheus text exposition format.
+
+    Returns
+    -------
+    str
+    """
+    with _lock:
+        items = sorted(_metrics.items(), key=lambda x: x[0])
+
+    lines = []
+    current = None
+    for (name, labels), metric in items:
+        if name != current:
+            lines.append('# TYPE {} {}'.format(name, metric.kind))
+            current = name
+        if metric.kind == 'counter':
+            lines.append('{}{} {}'.format(
+                name, _format_labels(labels), _format_value(metric.value)))
+        else:
+            for bound, count in metric.cumulative():
+                lines.append('{}_bucket{} {}'.format(
+                    name, _format_labels(labels, le=_format_value(bound)),
+                    count))
+            lines.append('{}_sum{} {}'.format(
+                name, _format_labels(labels), _format_value(metric.sum)))
+            lines.append('{}_count{} {}'.format(
+                name, _format_labels(labels), metric.count))
+    return '\n'.join(lines) + '\n' if lines else ''
@@ -1,3 +1,73 @@
 """
 Plugins extends metags by listening to events.
+
+Plugins aren't registered on import. Each plugin module provides a
+`register` function which is called explicitly through `register`, or for
+installed packages, through the ``metags.plugins`` entry point group::
+
+    entry_points={
+        'metags.plugins': ['myplugin = mypackage.myplugin:register'],
+    }
 """
+import importlib
+
+from typing import Callable, List
+
+
+ENTRY_POINT_GROUP = 'metags.plugins'
+
+# Names of plugins which have already been registered.
+_registered = set()
+
+
+def register(name):
+    """
+    Register a plugin by module name.
+
+    Parameters
+    ----------
+    name : str
+        Either the name of a module within `metags.plugins` or a full module
+        path.
+    """
+    if '.' not in name:
+        name = '{}.{}'.format(__name__, name)
+    if name in _registered:
+        return
+    importlib.import_module(name).register()
+    _registered.add(name)
+
+
+def register_entry_points(group=ENTRY_POINT_GROUP):
+    """
+    Register all plugins advertised by installed packages.
+
+    Parameters
+    ----------
+    group : str
+
+    Returns
+    -------
+    List[str]
+        Names of the registered entry points.
+    """
+    try:
+        from importlib.metadata import entry_points
+    except ImportError:
+        import pkg_resources
+        points = list(pkg_resources.iter_entry_points(group))
+    else:
+        points = entry_points()
+        if hasattr(points, 'select'):
+            points = list(points.select(group=group))
+        else:
+            points = list(points.get(group, []))
+
+    results = []
+    for point in points:
+        key = '{}:{}'.format(group, point.name)
+        if key not in _registered:
+            point.load()()
+            _registered.add(key)
+        results.append(point.name)
+    return results
@@ -15,7 +15,14 @@ IMAGE_EXT = ['.jpg', '.png']
 # FIXME: This system needs more thought on how it should work.
 
 
-@metags.events.listen('db_storage_add')
+def register():
+    """
+    Start listening for items added to database storage.
+    """
+    metags.events.listen('db_storage_add')(add_cloudvision_labels)
+    metags.events.listen('db_storage_add')(add_image_dimensions_labels)
+
+
 def add_cloudvision_labels(storage, item):
     """
     Callback for adding labels to an Item through google's vision API.
@@ -36,7 +43,6 @@ def add_cloudvision_labels(storage, item):
     return item
 
 
-@metags.events.listen('db_storage_add')
 def add_image_dimensions_labels(storage, item):
     """
     Callback for adding labels to an Item through google's vision API.
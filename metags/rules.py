@@ -0,0 +1,334 @@
+"""
+Rules deciding which files a walk keeps.
+
+Rules are checked in order and the first one matching decides whether a
+path is kept. Directory rules are checked before a directory is listed, so
+excluded trees are never walked. Cheap prefilters on the extension, size
+and modification time are applied from the directory listing::
+
+    rules = metags.rules.Rules([
+        metags.rules.exclude('.git', directory=True),
+        metags.rules.exclude('tmp', directory=True),
+        metags.rules.exclude('*_backup.*'),
+        metags.rules.include('*.png'),
+        metags.rules.include('*.exr'),
+    ], default=False, min_size=1)
+    factory.generate('/Users/samb/Pictures', pattern=rules)
+"""
+import os
+import re
+import fnmatch
+import itertools
+import attr
+import six
+
+from typing import Any, Callable, Iterable, Iterator, List, Optional, Tuple, \
+    Union
+
+
+@attr.s(frozen=True)
+class Rule(object):
+    """
+    Include or exclude paths matching a pattern.
+
+    Globs without a path separator match the file or directory name,
+    otherwise the whole path. Regular expressions are matched against the
+    whole path.
+    """
+    include = attr.ib()
+    pattern = attr.ib()
+    regex = attr.ib(default=False)
+    # Whether the rule applies to directories rather than files.
+    directory = attr.ib(default=False)
+
+
+def include(pattern, regex=False, directory=False):
+    """
+    Parameters
+    ----------
+    pattern : Union[str, _sre.SRE_Pattern]
+    regex : bool
+        Whether `pattern` is a regular expression rather than a glob.
+    directory : bool
+        Whether the rule applies to directories rather than files.
+
+    Returns
+    -------
+    Rule
+    """
+    return Rule(True, pattern, regex=regex, directory=directory)
+
+
+def exclude(pattern, regex=False, directory=False):
+    """
+    Parameters
+    ----------
+    pattern : Union[str, _sre.SRE_Pattern]
+    regex : bool
+        Whether `pattern` is a regular expression rather than a glob.
+    directory : bool
+        Whether the rule applies to directories rather than files. Excluded
+        directories aren't walked at all.
+
+    Returns
+    -------
+    Rule
+    """
+    return Rule(False, pattern, regex=regex, directory=directory)
+
+
+class Rules(object):
+    """
+    Ordered include and exclude rules, compiled once, plus prefilters on
+    file stat info.
+    """
+    def __init__(self, rules=(), default=True, extensions=None,
+                 min_size=None, max_size=None, newer=None, older=None):
+        """
+        Parameters
+        ----------
+        rules : Iterable[Rule]
+            Checked in order, the first matching rule decides.
+        default : bool
+            Whether files no rule matches are kept. Directories no rule
+            matches are always walked.
+        extensions : Optional[Iterable[str]]
+            Only keep files with one of these extensions, e.g. ('png',
+            '.exr'). Compared case-insensitively.
+        min_size : Optional[int]
+            Only keep files of at least this many bytes.
+        max_size : Optional[int]
+            Only keep files of at most this many bytes.
+        newer : Optional[float]
+            Only keep files modified at or after this timestamp.
+        older : Optional[float]
+            Only keep files modified before this timestamp.
+        """
+        self.rules = list(rules)
+        self.default = default
+        self.extensions = None if extensions is None else frozenset(
+            '.' + x.lstrip('.').lower() for x in extensions)
+        self.min_size = min_size
+        self.max_size = max_size
+        self.newer = newer
+        self.older = older
+        self._files = _compile(x for x in self.rules if not x.directory)
+        self._dirs = _compile(x for x in self.rules if x.directory)
+        self._stat = any(x is not None
+                         for x in (min_size, max_size, newer, older))
+
+    @classmethod
+    def from_pattern(cls, pattern):
+        """
+        Only keep files whose whole path matches a regular expression.
+
+        Parameters
+        ----------
+        pattern : Union[str, _sre.SRE_Pattern]
+
+        Returns
+        -------
+        Rules
+        """
+        if isinstance(pattern, six.string_types):
+            pattern = re.compile(pattern)
+        return cls([include(pattern, regex=True)], default=False)
+
+    def prune(self, path, name=None):
+        """
+        Whether a directory should be skipped rather than walked.
+
+        Parameters
+        ----------
+        path : str
+        name : Optional[str]
+            Base name of `path`, if already known.
+
+        Returns
+        -------
+        bool
+        """
+        if not self._dirs:
+            return False
+        return not _first(self._dirs, path, name or os.path.basename(path),
+                          True)
+
+    def accept(self, entry):
+        """
+        Whether a file from a directory listing should be kept. Stat info is
+        only requested when a size or time prefilter is set.
+
+        Parameters
+        ----------
+        entry : os.DirEntry
+
+        Returns
+        -------
+        bool
+        """
+        return self._accept(entry.path, entry.name, entry.stat)
+
+    def match(self, path, root=None):
+        """
+        Whether a file should be kept, given only its path.
+
+        Parameters
+        ----------
+        path : str
+        root : Optional[str]
+            Root of the walk. If given, the file is also rejected when any
+            directory between the root and the file would be pruned.
+
+        Returns
+        -------
+        bool
+        """
+        if root is not None and self._dirs:
+            parent = os.path.dirname(path)
+            root = root.rstrip(os.sep)
+            while parent.startswith(root + os.sep):
+                if self.prune(parent):
+                    return False
+                parent = os.path.dirname(parent)
+        return self._accept(path, os.path.basename(path),
+                            lambda: os.stat(path))
+
+    def scan(self, path):
+        """
+        List a directory, applying the rules.
+
+        Parameters
+        ----------
+        path : str
+
+        Returns
+        -------
+        Tuple[List[str], List[str]]
+            Paths of the directories to walk and of the files to keep.
+        """
+        dirs = []
+        files = []
+        for entry in os.scandir(path):
+            if entry.is_dir():
+                if not self.prune(entry.path, entry.name):
+                    dirs.append(entry.path)
+            elif self.accept(entry):
+                files.append(entry.path)
+        return dirs, files
+
+    def walk(self, path):
+        """
+        Walk a tree, skipping pruned directories.
+
+        Parameters
+        ----------
+        path : str
+
+        Returns
+        -------
+        Iterator[str]
+            Paths of the files to keep.
+        """
+        stack = [path]
+        while stack:
+            dirs, files = self.scan(stack.pop())
+            for x in files:
+                yield x
+            stack.extend(reversed(dirs))
+
+    def _accept(self, path, name, stat):
+        """
+        Parameters
+        ----------
+        path : str
+        name : str
+        stat : Callable[[], os.stat_result]
+
+        Returns
+        -------
+        bool
+        """
+        if self.extensions is not None and \
+                os.path.splitext(name)[1].lower() not in self.extensions:
+            return False
+        if not _first(self._files, path, name, self.default):
+            return False
+        if not self._stat:
+            return True
+        try:
+            statinfo = stat()
+        except OSError:
+            return False
+        return not (
+            (self.min_size is not None and statinfo.st_size < self.min_size) or
+            (self.max_size is not None and statinfo.st_size > self.max_size) or
+            (self.newer is not None and statinfo.st_mtime < self.newer) or
+            (self.older is not None and statinfo.st_mtime >= self.older))
+
+
+def as_rules(pattern):
+    """
+    Get rules from the `pattern` argument accepted by walks.
+
+    Parameters
+    ----------
+    pattern : Optional[Union[str, _sre.SRE_Pattern, Rules]]
+        A regular expression is matched against the whole path of each
+        file, as before rules were supported.
+
+    Returns
+    -------
+    Rules
+    """
+    if isinstance(pattern, Rules):
+        return pattern
+    if not pattern:
+        return Rules()
+    return Rules.from_pattern(pattern)
+
+
+def _compile(rules):
+    """
+    Combine runs of glob rules with the same outcome into as few regular
+    expressions as possible. Regular expression rules are compiled on their
+    own, as they may carry inline flags which can't be combined.
+
+    Parameters
+    ----------
+    rules : Iterable[Rule]
+
+    Returns
+    -------
+    List[Tuple[bool, Optional[_sre.SRE_Pattern], Optional[_sre.SRE_Pattern]]]
+        Outcome, then the expressions matching the name and the whole path.
+    """
+    compiled = []
+    for outcome, run in itertools.groupby(rules, lambda x: x.include):
+        names = []
+        paths = []
+        for rule in run:
+            if rule.regex or not isinstance(rule.pattern, six.string_types):
+                compiled.append((outcome, _union(names), _union(paths)))
+                compiled.append((outcome, None, re.compile(rule.pattern)))
+                names = []
+                paths = []
+            elif os.sep in rule.pattern:
+                paths.append(fnmatch.translate(rule.pattern))
+            else:
+                names.append(fnmatch.translate(rule.pattern))
+        compiled.append((outcome, _union(names), _union(paths)))
+    return [x for x in compiled if x[1] is not None or x[2] is not None]
+
+
+def _union(patterns):
+    if not patterns:
+        return None
+    return re.compile('|'.join('(?:{})'.format(x) for x in patterns))
+
+
+def _first(compiled, path, name, default):
+    for outcome, names, paths in compiled:
+        if (names is not None and names.match(name)) or \
+                (paths is not None and paths.match(path)):
+            return outcome
+    return default
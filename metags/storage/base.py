@@ -9,6 +9,12 @@ if TYPE_CHECKING:
     import metags.core
 
 
+# Ways an item's metadata can be applied to what is stored when updating.
+# 'merge' adds to the stored values, 'replace' replaces the stored values of
+# each key the item has.
+UPDATE_MODES = ('merge', 'replace')
+
+
 class AbstractStorageEngine(object):
     """
     Abstracted class for defining the interface of storage engines.
@@ -47,3 +53,45 @@ class AbstractStorageEngine(object):
         List[metags.core.Item]
         """
         raise NotImplementedError
+
+    @abstractmethod
+    def remove(self, url):
+        """
+        Remove the item(s) stored at a url.
+
+        Anything stored below the url, as if it were a directory, is removed
+        as well.
+
+        Parameters
+        ----------
+        url : str
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def move(self, src, dst):
+        """
+        Change the url of stored item(s) without re-hashing them.
+
+        Anything stored below `src`, as if it were a directory, is moved
+        below `dst`.
+
+        Parameters
+        ----------
+        src : str
+        dst : str
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def duplicates(self):
+        """
+        Group urls by identical content.
+
+        Returns
+        -------
+        Dict[str, List[str]]
+            Urls keyed by the c4 id they share. Only c4 ids shared by more
+            than one url are included.
+        """
+        raise NotImplementedError
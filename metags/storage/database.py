@@ -1,16 +1,18 @@
 """
 Database storage model.
 """
+import os
+import time
+import itertools
+import collections
+import six
+import metags.utils
+import metags.metrics
 from metags.core import Item
-from metags.events import event
-from metags.storage.base import AbstractStorageEngine
-from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, \
-    UniqueConstraint
-from sqlalchemy.orm import sessionmaker, relationship, joinedload, aliased
-from sqlalchemy.orm.exc import NoResultFound
-from sqlalchemy.ext.declarative import declarative_base
+from metags.events import event, emit
+from metags.storage.base import AbstractStorageEngine, UPDATE_MODES
 
-from typing import TYPE_CHECKING, Optional, Dict, Any, List
+from typing import TYPE_CHECKING, Optional, Dict, Any, Iterable, List
 
 
 if TYPE_CHECKING:
@@ -18,44 +20,40 @@ if TYPE_CHECKING:
     import sqlalchemy.orm.session
 
 
-Base = declarative_base()
-
-
-class Entity(Base):
-    __tablename__ = 'entity'
-    id = Column(Integer, autoincrement=True, primary_key=True)
-    url = Column(String, index=True)
-    c4 = Column(String)
-
-    UniqueConstraint(url, c4)
-
-    meta = relationship('LinkMeta')
-
-    def __repr__(self):
-        return '{}(id={!r}, url={!r}, c4={!r})'.format(
-            self.__class__.__name__, self.id, self.url, self.c4)
-
-
-class Meta(Base):
-    __tablename__ = 'meta'
-    id = Column(Integer, autoincrement=True, primary_key=True)
-    content = Column(String, index=True)
-
-
-class LinkMeta(Base):
-    __tablename__ = 'link_meta'
-    id = Column(Integer, autoincrement=True, primary_key=True)
-    entity_id = Column(Integer, ForeignKey(Entity.id))
-    key_id = Column(Integer, ForeignKey(Meta.id))
-    key = relationship(Meta, primaryjoin='LinkMeta.key_id == Meta.id')
-    value_id = Column(Integer, ForeignKey(Meta.id))
-    value = relationship(Meta, primaryjoin='LinkMeta.value_id == Meta.id')
+def __getattr__(name):
+    # The models used to live here. Forward to them lazily so importing this
+    # module doesn't import sqlalchemy.
+    if name in ('Base', 'Entity', 'Meta', 'LinkMeta', 'ChangeLog'):
+        import metags.storage.models
+        return getattr(metags.storage.models, name)
+    raise AttributeError(
+        'module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+# An entry of the change log.
+#   seq : int
+#       Increases with every change. Pass the last seq seen to
+#       `DatabaseStorageEngine.changes_since` to read on from there.
+#   entity : int
+#       Id of the changed entity, which stays the same across moves.
+#   operation : str
+#       One of 'add', 'update_meta', 'move' or 'remove'.
+#   url : str
+#       Url of the entity after the change.
+#   c4 : str
+#   timestamp : float
+Change = collections.namedtuple(
+    'Change', 'seq entity operation url c4 timestamp')
 
 
 class Transaction(object):
+    """
+    Commits the session on exit, or rolls it back if an exception was
+    raised.
 
-    # FIXME: support nested transactions
-
+    Transactions may be nested, in which case only the outermost one
+    commits or rolls back and inner ones just flush.
+    """
     def __init__(self, session):
         """
         Parameters
@@ -70,30 +68,90 @@ class Transaction(object):
         -------
         sqlalchemy.orm.session.Session
         """
+        depth = self.session.info.get('metags_depth', 0)
+        if not depth and self.session.bind.dialect.name == 'sqlite':
+            # end any read started outside a transaction, then take the
+            # write lock up front. A read upgraded to a write can't wait for
+            # other writers and fails with "database is locked" instead.
+            self.session.commit()
+            self.session.connection(
+                execution_options={'metags_immediate': True})
+        self.session.info['metags_depth'] = depth + 1
         return self.session
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        try:
-            self.session.commit()
-        except Exception:
+        depth = self.session.info['metags_depth'] - 1
+        self.session.info['metags_depth'] = depth
+        if depth:
+            if exc_type is None:
+                self.session.flush()
+        elif exc_type is not None:
             self.session.rollback()
-            raise
+        else:
+            try:
+                self.session.commit()
+            except Exception:
+                self.session.rollback()
+                raise
 
 
 class DatabaseStorageEngine(AbstractStorageEngine):
     """
     Database storage engine.
     """
-    def __init__(self, db='sqlite://'):
+    def __init__(self, db='sqlite://', changelog=True, timeout=60.0):
         """
         Parameters
         ----------
         db : str
             Database url.
+        changelog : bool
+            Record changes in the change log, within the same transaction
+            as the change itself. See `changes_since`.
+        timeout : float
+            Seconds to wait for other processes writing to a sqlite
+            database.
+        """
+        self.db = db
+        self.changelog = changelog
+        self.timeout = timeout
+        self._session = None
+
+    @property
+    def session(self):
+        """
+        Database session, connecting and creating tables on first use.
+
+        Returns
+        -------
+        sqlalchemy.orm.session.Session
+        """
+        if self._session is None:
+            from sqlalchemy import create_engine
+            from sqlalchemy.orm import sessionmaker
+            from metags.storage.models import Base
+            from sqlalchemy.engine.url import make_url
+            if make_url(self.db).get_backend_name() == 'sqlite':
+                engine = create_engine(
+                    self.db, connect_args={'timeout': self.timeout})
+                _configure_sqlite(engine)
+            else:
+                engine = create_engine(self.db)
+            metags.metrics.instrument_engine(engine)
+            Base.metadata.create_all(engine)
+            upgrade_schema(engine)
+            self._session = sessionmaker(bind=engine)()
+        return self._session
+
+    def close(self):
+        """
+        Close the session and its database connections.
         """
-        self._engine = create_engine(db)
-        Base.metadata.create_all(self._engine)
-        self.session = sessionmaker(bind=self._engine)()
+        if self._session is not None:
+            engine = self._session.bind
+            self._session.close()
+            engine.dispose()
+            self._session = None
 
     def transaction(self):
         """
@@ -115,7 +173,7 @@ class DatabaseStorageEngine(AbstractStorageEngine):
         -------
         metags.core.Item
         """
-        item = Item(url=entity.url, c4=entity.c4)
+        item = Item(url=entity.url, c4=metags.utils.c4encode(entity.c4))
         for meta in entity.meta:
             item.tag(meta.key.content, meta.value.content)
         return item
@@ -132,8 +190,10 @@ class DatabaseStorageEngine(AbstractStorageEngine):
         -------
         Entity
         """
+        from sqlalchemy.orm import joinedload
+        from metags.storage.models import Entity
         return self.session.query(Entity) \
-            .filter_by(url=item.url, c4=item.c4) \
+            .filter_by(url=item.url, c4=metags.utils.c4decode(item.c4)) \
             .options(joinedload('meta')) \
             .one()
 
@@ -149,7 +209,10 @@ class DatabaseStorageEngine(AbstractStorageEngine):
         -------
         Meta
         """
-        with self.transaction() as session:
+        from sqlalchemy.orm.exc import NoResultFound
+        from metags.storage.models import Meta
+        with metags.metrics.stage('meta_resolve'), \
+                self.transaction() as session:
             try:
                 meta = session.query(Meta).filter_by(content=content).one()
             except NoResultFound:
@@ -165,7 +228,15 @@ class DatabaseStorageEngine(AbstractStorageEngine):
         ----------
         entity : Entity
         metadata : dict
+
+        Returns
+        -------
+        int
+            Number of relationships created.
         """
+        from sqlalchemy.orm.exc import NoResultFound
+        from metags.storage.models import LinkMeta
+        created = 0
         with self.transaction() as session:
             for k, v in metadata.items():
                 key = self.fetch_meta(k)
@@ -179,16 +250,186 @@ class DatabaseStorageEngine(AbstractStorageEngine):
                             .one()
                     except NoResultFound:
                         session.add(LinkMeta(**kwargs))
+                        created += 1
+        return created
 
-    def update_meta(self, item):
+    def resolve_meta(self, contents):
+        """
+        Get the ids of existing meta, creating any that are missing in bulk.
+
+        Parameters
+        ----------
+        contents : Iterable[str]
+
+        Returns
+        -------
+        Dict[str, int]
+            Meta ids keyed by content.
+        """
+        from metags.storage.models import Meta
+        contents = set(contents)
+        ids = {}
+        with metags.metrics.stage('meta_resolve'), \
+                self.transaction() as session:
+            for chunk in _chunks(sorted(contents)):
+                query = session.query(Meta.id, Meta.content)\
+                    .filter(Meta.content.in_(chunk))\
+                    .order_by(Meta.id)
+                for id, content in query:
+                    ids.setdefault(content, id)
+            missing = sorted(contents.difference(ids))
+            if missing:
+                session.bulk_insert_mappings(
+                    Meta, [dict(content=x) for x in missing])
+                for chunk in _chunks(missing):
+                    query = session.query(Meta.id, Meta.content)\
+                        .filter(Meta.content.in_(chunk))
+                    ids.update((content, id) for id, content in query)
+        return ids
+
+    def update_meta(self, item, mode='merge'):
         """
         Update metadata for the given item.
         
         Parameters
         ----------
         item : metags.core.Item
+        mode : str
+            See `update_meta_many`.
+        """
+        self.update_meta_many([item], mode=mode)
+
+    def update_meta_many(self, items, mode='merge'):
         """
-        self.link_meta(self.to_entity(item), item.metadata)
+        Update metadata for many items.
+
+        The stored metadata of all items is loaded in one pass and compared
+        with the items' metadata, so only links which actually changed are
+        inserted or deleted.
+
+        Parameters
+        ----------
+        items : Iterable[metags.core.Item]
+        mode : str
+            'merge' adds the items' metadata to what is stored. 'replace'
+            replaces the stored values of each key the item has, so tagging
+            a key with an empty list removes it. Keys the item doesn't have
+            are left alone either way.
+
+        Raises
+        ------
+        sqlalchemy.orm.exc.NoResultFound
+            If an item isn't stored.
+        """
+        from sqlalchemy.orm.exc import NoResultFound
+        if mode not in UPDATE_MODES:
+            raise ValueError('Unknown update mode {!r}. Expected one of {}'
+                             .format(mode, UPDATE_MODES))
+        items = list(items)
+        # read within the transaction, so concurrent writers can't both
+        # insert the same missing links
+        with self.transaction():
+            ids = self._entity_ids(x.url for x in items)
+            for item in items:
+                if (item.url, metags.utils.c4decode(item.c4)) not in ids:
+                    raise NoResultFound(
+                        'No stored item for {!r}'.format(item.url))
+            self._update_links(items, ids, mode)
+
+    def _entity_ids(self, urls):
+        """
+        Look up the ids of entities stored at urls.
+
+        Parameters
+        ----------
+        urls : Iterable[str]
+
+        Returns
+        -------
+        Dict[Tuple[str, bytes], int]
+            Entity ids keyed by url and c4 digest.
+        """
+        from metags.storage.models import Entity
+        ids = {}
+        for chunk in _chunks(sorted(set(urls))):
+            query = self.session.query(Entity.id, Entity.url, Entity.c4)\
+                .filter(Entity.url.in_(chunk))
+            ids.update(((url, digest), id) for id, url, digest in query)
+        return ids
+
+    def _update_links(self, items, ids, mode, unlogged=()):
+        """
+        Write the difference between the items' metadata and the stored
+        metadata. See `update_meta_many`.
+
+        Parameters
+        ----------
+        items : List[metags.core.Item]
+        ids : Dict[Tuple[str, bytes], int]
+            See `_entity_ids`.
+        mode : str
+        unlogged : Iterable[int]
+            Entities whose changes are already in the change log.
+        """
+        from sqlalchemy.orm import aliased
+        from metags.storage.models import Entity, Meta, LinkMeta
+        with self.transaction() as session:
+            with metags.metrics.stage('meta_diff'):
+                # metadata to store, as text like it is read back
+                wanted = {}
+                for item in items:
+                    key = (item.url, metags.utils.c4decode(item.c4))
+                    links = wanted.setdefault(ids[key], {})
+                    for k, values in item.metadata.items():
+                        links.setdefault(_text(k), set()).update(
+                            _text(x) for x in values)
+
+                keys = aliased(Meta)
+                values = aliased(Meta)
+                stored = {}
+                for chunk in _chunks(sorted(wanted)):
+                    query = session.query(LinkMeta.id, LinkMeta.entity_id,
+                                          keys.content, values.content)\
+                        .join(keys, LinkMeta.key_id == keys.id)\
+                        .join(values, LinkMeta.value_id == values.id)\
+                        .filter(LinkMeta.entity_id.in_(chunk))
+                    for id, entity_id, key, value in query:
+                        stored.setdefault(entity_id, {})\
+                            .setdefault((key, value), []).append(id)
+
+                inserts = []
+                deletes = []
+                changed = set()
+                for entity_id, links in wanted.items():
+                    existing = stored.get(entity_id, {})
+                    for key, contents in links.items():
+                        inserts.extend((entity_id, key, x) for x in contents
+                                       if (key, x) not in existing)
+                    if mode == 'replace':
+                        for (key, value), link_ids in existing.items():
+                            if key in links and value not in links[key]:
+                                deletes.extend(link_ids)
+                                changed.add(entity_id)
+                changed.update(x[0] for x in inserts)
+
+            if not changed:
+                return
+
+            with metags.metrics.stage('meta_write'):
+                for chunk in _chunks(deletes):
+                    session.query(LinkMeta)\
+                        .filter(LinkMeta.id.in_(chunk))\
+                        .delete(synchronize_session=False)
+                if inserts:
+                    metas = self.resolve_meta(itertools.chain.from_iterable(
+                        (key, value) for _, key, value in inserts))
+                    session.bulk_insert_mappings(LinkMeta, [
+                        dict(entity_id=entity_id, key_id=metas[key],
+                             value_id=metas[value])
+                        for entity_id, key, value in inserts])
+                for chunk in _chunks(sorted(changed.difference(unlogged))):
+                    self.log_change('update_meta', Entity.id.in_(chunk))
+                session.expire_all()
 
     @event('db_storage_add')
     def add(self, item):
@@ -203,26 +444,317 @@ class DatabaseStorageEngine(AbstractStorageEngine):
         -------
         metags.core.Item
         """
+        from sqlalchemy.orm.exc import NoResultFound
+        from metags.storage.models import Entity
         # FIXME: Handle this by emitting an event instead. The goal would be
         # to offload calculating this to workers in parallel. Just use
         # sqlalchemy's event system to monitor new Entity rows?
         if not item.c4:
-            item.c4 = item.c4id()
+            with metags.metrics.stage('hash'):
+                item.c4 = item.c4id()
 
-        with self.transaction() as session:
+        with metags.metrics.stage('insert'), self.transaction() as session:
             try:
                 entity = self.to_entity(item)
+                operation = None
             except NoResultFound:
-                entity = Entity(c4=item.c4, url=item.url)
+                entity = Entity(c4=metags.utils.c4decode(item.c4),
+                                url=item.url)
                 session.add(entity)
+                operation = 'add'
 
-            self.link_meta(entity, item.metadata)
+            if self.link_meta(entity, item.metadata) and operation is None:
+                operation = 'update_meta'
+            if operation is not None:
+                session.flush()
+                self.log_change(operation, Entity.id == entity.id)
 
         return self, item
 
+    def _tree(self, url):
+        """
+        Filter matching entities at or below a url.
+
+        Parameters
+        ----------
+        url : str
+
+        Returns
+        -------
+        sqlalchemy.sql.elements.ClauseElement
+        """
+        from sqlalchemy import or_
+        from metags.storage.models import Entity
+        prefix = url.rstrip(os.sep) + os.sep
+        escaped = prefix.replace('\\', '\\\\').replace('%', '\\%')\
+            .replace('_', '\\_')
+        return or_(Entity.url == url,
+                   Entity.url.like(escaped + '%', escape='\\'))
+
+    def get_tree(self, url):
+        """
+        Get `Item`s stored at or below a url.
+
+        Parameters
+        ----------
+        url : str
+
+        Returns
+        -------
+        List[metags.core.Item]
+        """
+        from metags.storage.models import Entity
+        query = self.session.query(Entity).filter(self._tree(url))
+        return [self.to_item(x) for x in query]
+
+    def remove(self, url):
+        """
+        Remove the item(s) stored at a url.
+
+        Anything stored below the url, as if it were a directory, is removed
+        as well.
+
+        Parameters
+        ----------
+        url : str
+        """
+        from metags.storage.models import Entity, LinkMeta
+        with self.transaction() as session:
+            self.log_change('remove', self._tree(url))
+            ids = session.query(Entity.id).filter(self._tree(url))
+            session.query(LinkMeta)\
+                .filter(LinkMeta.entity_id.in_(ids.subquery()))\
+                .delete(synchronize_session=False)
+            session.query(Entity)\
+                .filter(self._tree(url))\
+                .delete(synchronize_session=False)
+            session.expire_all()
+
+    def move(self, src, dst):
+        """
+        Change the url of stored item(s) without re-hashing them.
+
+        Anything stored below `src`, as if it were a directory, is moved
+        below `dst`.
+
+        Parameters
+        ----------
+        src : str
+        dst : str
+        """
+        from sqlalchemy import func, literal
+        from metags.storage.models import Entity
+        src = src.rstrip(os.sep)
+        dst = dst.rstrip(os.sep)
+        with self.transaction() as session:
+            # entities already below dst didn't move, so aren't logged
+            ids = [x for x, in session.query(Entity.id)
+                   .filter(self._tree(src))]
+            session.query(Entity)\
+                .filter(self._tree(src))\
+                .update({Entity.url: literal(dst).concat(
+                    func.substr(Entity.url, len(src) + 1))},
+                    synchronize_session=False)
+            for chunk in _chunks(ids):
+                self.log_change('move', Entity.id.in_(chunk))
+            session.expire_all()
+
+    def add_many(self, items):
+        """
+        Add many items to storage within a single transaction.
+
+        New entities, meta and links are inserted in bulk, rather than
+        looked up one at a time like `add` does. Listeners of
+        'db_storage_add' are still called for each item.
+
+        Parameters
+        ----------
+        items : Iterable[metags.core.Item]
+
+        Returns
+        -------
+        List[metags.core.Item]
+        """
+        from metags.storage.models import Entity
+        items = list(items)
+        if any(not x.c4 for x in items):
+            with metags.metrics.stage('hash'):
+                for item in items:
+                    if not item.c4:
+                        item.c4 = item.c4id()
+
+        with metags.metrics.stage('insert'), self.transaction() as session:
+            ids = self._entity_ids(x.url for x in items)
+            new = []
+            for item in items:
+                key = (item.url, metags.utils.c4decode(item.c4))
+                if key not in ids:
+                    ids[key] = None
+                    new.append(key)
+            added = []
+            if new:
+                session.bulk_insert_mappings(
+                    Entity, [dict(url=url, c4=digest) for url, digest in new])
+                ids.update(self._entity_ids(url for url, _ in new))
+                added = sorted(ids[x] for x in new)
+                for chunk in _chunks(added):
+                    self.log_change('add', Entity.id.in_(chunk))
+            self._update_links(items, ids, 'merge', unlogged=added)
+
+        for item in items:
+            emit('db_storage_add', (self, item))
+        return items
+
+    def log_change(self, operation, criterion):
+        """
+        Append the entities matching a filter to the change log, as part of
+        the current transaction. Does nothing if the change log is disabled.
+
+        Parameters
+        ----------
+        operation : str
+        criterion : sqlalchemy.sql.elements.ClauseElement
+            Filter on `Entity`.
+        """
+        from sqlalchemy import select, literal
+        from metags.storage.models import Entity, ChangeLog
+        if not self.changelog:
+            return
+        query = select([Entity.id, Entity.url, Entity.c4,
+                        literal(operation), literal(time.time())])\
+            .where(criterion)\
+            .order_by(Entity.id)
+        with self.transaction() as session:
+            session.execute(ChangeLog.__table__.insert().from_select(
+                ['entity_id', 'url', 'c4', 'operation', 'timestamp'],
+                query))
+
+    def changes_since(self, seq=0, limit=1000):
+        """
+        Read the change log.
+
+        Mirrors of the catalog can stay up to date by keeping the seq of the
+        last change they applied and polling from there. Changes are keyed
+        by entity, so a 'move' or 'remove' applies to whatever the mirror
+        holds for that entity.
+
+        Parameters
+        ----------
+        seq : int
+            Only return changes after this seq.
+        limit : Optional[int]
+            Maximum number of changes to return.
+
+        Returns
+        -------
+        List[Change]
+            Changes in the order they were made.
+        """
+        from metags.storage.models import ChangeLog
+        query = self.session.query(ChangeLog)\
+            .filter(ChangeLog.seq > seq)\
+            .order_by(ChangeLog.seq)\
+            .limit(limit)
+        return [Change(seq=x.seq, entity=x.entity_id, operation=x.operation,
+                       url=x.url, c4=metags.utils.c4encode(x.c4),
+                       timestamp=x.timestamp)
+                for x in query]
+
+    def last_change(self):
+        """
+        Returns
+        -------
+        int
+            Seq of the latest change, or 0 if nothing was logged. A new
+            mirror can copy `all()` and then read changes from here.
+        """
+        from sqlalchemy import func
+        from metags.storage.models import ChangeLog
+        return self.session.query(func.max(ChangeLog.seq)).scalar() or 0
+
+    def compact_changes(self, before=None, tombstones=None):
+        """
+        Shrink the change log.
+
+        Only the latest change of each entity is kept, which is enough for a
+        mirror that is behind to catch up. Changes from `before` onwards are
+        kept as they are, so mirrors reading close to the end of the log
+        still see every change.
+
+        Parameters
+        ----------
+        before : Optional[int]
+            Seq to compact up to. Defaults to the whole log.
+        tombstones : Optional[float]
+            Also drop 'remove' changes older than this many seconds. Mirrors
+            further behind than that should be copied again from scratch.
+            By default they are kept forever.
+
+        Returns
+        -------
+        int
+            Number of changes dropped.
+        """
+        from sqlalchemy import func, and_
+        from metags.storage.models import ChangeLog
+        if before is None:
+            before = self.last_change() + 1
+        with self.transaction() as session:
+            latest = session.query(func.max(ChangeLog.seq))\
+                .filter(ChangeLog.seq < before)\
+                .group_by(ChangeLog.entity_id)
+            dropped = session.query(ChangeLog)\
+                .filter(ChangeLog.seq < before)\
+                .filter(~ChangeLog.seq.in_(latest.subquery()))\
+                .delete(synchronize_session=False)
+            if tombstones is not None:
+                dropped += session.query(ChangeLog)\
+                    .filter(and_(ChangeLog.seq < before,
+                                 ChangeLog.operation == 'remove',
+                                 ChangeLog.timestamp < time.time() -
+                                 tombstones))\
+                    .delete(synchronize_session=False)
+        return dropped
+
+    def page(self, after=0, limit=1000):
+        """
+        Get a batch of stored items in id order, along with their metadata.
+
+        Use this to walk large catalogs without holding them in memory.
+
+        Parameters
+        ----------
+        after : int
+            Only return items stored after this id. Pass the id returned
+            with the previous batch to get the next one.
+        limit : int
+
+        Returns
+        -------
+        Tuple[List[metags.core.Item], Optional[int]]
+            Items and the id to pass as `after` for the next batch, which is
+            None once there are no more items.
+        """
+        from sqlalchemy.orm import selectinload
+        from metags.storage.models import Entity, LinkMeta
+        entities = self.session.query(Entity)\
+            .filter(Entity.id > after)\
+            .order_by(Entity.id)\
+            .limit(limit)\
+            .options(selectinload(Entity.meta).joinedload(LinkMeta.key),
+                     selectinload(Entity.meta).joinedload(LinkMeta.value))\
+            .all()
+        items = [self.to_item(x) for x in entities]
+        if len(entities) < limit:
+            return items, None
+        return items, entities[-1].id
+
     def __iter__(self):
-        for entity in self.session.query(Entity):
-            yield self.to_item(entity)
+        after = 0
+        while after is not None:
+            items, after = self.page(after)
+            for item in items:
+                yield item
 
     def all(self):
         """
@@ -232,6 +764,29 @@ class DatabaseStorageEngine(AbstractStorageEngine):
         """
         return list(self)
 
+    def duplicates(self):
+        """
+        Group urls by identical content.
+
+        Returns
+        -------
+        Dict[str, List[str]]
+            Urls keyed by the c4 id they share. Only c4 ids shared by more
+            than one url are included.
+        """
+        from sqlalchemy import func
+        from metags.storage.models import Entity
+        shared = self.session.query(Entity.c4)\
+            .group_by(Entity.c4)\
+            .having(func.count(Entity.id) > 1)\
+            .subquery()
+        query = self.session.query(Entity.c4, Entity.url)\
+            .join(shared, Entity.c4 == shared.c.c4)\
+            .order_by(Entity.c4, Entity.url)
+        return dict(
+            (metags.utils.c4encode(digest), [url for _, url in rows])
+            for digest, rows in itertools.groupby(query, lambda x: x[0]))
+
     def get(self, c4=None, url=None, **metadata):
         """
         Get `Item`s from either a c4 id, a url or metadata value(s).
@@ -250,12 +805,28 @@ class DatabaseStorageEngine(AbstractStorageEngine):
         -------
         List[metags.core.Item]
         """
+        from sqlalchemy.orm import aliased
+        from metags.storage.models import Entity, Meta, LinkMeta
         if c4 is not None:
             if '*' in c4 or '%' in c4:
+                pattern = c4.replace('%', '*')
+                prefix = pattern.rstrip('*')
+                if '*' in prefix:
+                    # Wildcards within the id can't be mapped onto the index.
+                    import fnmatch
+                    return [x for x in self
+                            if fnmatch.fnmatchcase(x.c4, pattern)]
+                bounds = metags.utils.c4range(prefix)
+                if bounds is None:
+                    return []
                 query = self.session.query(Entity)\
-                    .filter(Entity.c4.like(c4.replace('*', '%')))
+                    .filter(Entity.c4.between(*bounds))
             else:
-                query = self.session.query(Entity).filter(Entity.c4 == c4)
+                try:
+                    digest = metags.utils.c4decode(c4)
+                except ValueError:
+                    return []
+                query = self.session.query(Entity).filter(Entity.c4 == digest)
         elif url is not None:
             if '*' in url or '%' in url:
                 query = self.session.query(Entity)\
@@ -289,3 +860,111 @@ class DatabaseStorageEngine(AbstractStorageEngine):
             return self.all()
 
         return [self.to_item(x) for x in query]
+
+
+def _configure_sqlite(engine):
+    """
+    Let several processes write to a sqlite database.
+
+    The database is switched to write-ahead logging so readers don't block
+    the writer, and transactions opened by `Transaction` begin with
+    BEGIN IMMEDIATE so writers queue for the lock, up to the connection
+    timeout, rather than failing.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+    """
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        # let SQLAlchemy emit BEGIN rather than pysqlite
+        dbapi_connection.isolation_level = None
+        dbapi_connection.execute('PRAGMA journal_mode=WAL')
+
+    @event.listens_for(engine, 'begin')
+    def begin(conn):
+        if conn.get_execution_options().get('metags_immediate'):
+            conn.execute('BEGIN IMMEDIATE')
+        else:
+            conn.execute('BEGIN')
+
+
+def upgrade_schema(engine):
+    """
+    Upgrade a database written before c4 ids were stored as binary digests.
+
+    Text c4 ids are decoded in place, in batches, and the c4 index is created
+    within a single transaction. Up to date databases are left alone, which
+    is detected from the index alone so it's cheap to call on every connect.
+
+    Parameters
+    ----------
+    engine : sqlalchemy.engine.Engine
+
+    Raises
+    ------
+    RuntimeError
+        If the database needs upgrading but isn't sqlite.
+    ValueError
+        If a stored c4 id isn't valid.
+    """
+    from sqlalchemy import inspect, text, bindparam
+    from metags.storage.models import Entity
+    table = Entity.__table__
+    indexes = inspect(engine).get_indexes(table.name)
+    if any(x['column_names'] == ['c4'] for x in indexes):
+        return
+    if engine.dialect.name != 'sqlite':
+        raise RuntimeError(
+            '{} stores c4 ids as text. Convert entity.c4 to binary digests '
+            'with metags.utils.c4decode and index it before opening it with '
+            'this version of metags.'.format(engine.url))
+
+    select = text('SELECT id, c4 FROM entity WHERE typeof(c4) = \'text\' '
+                  'LIMIT :limit')
+    update = table.update()\
+        .where(table.c.id == bindparam('_id'))\
+        .values(c4=bindparam('_c4'))
+    with engine.begin() as conn:
+        while True:
+            rows = conn.execute(select, limit=10000).fetchall()
+            if not rows:
+                break
+            values = []
+            for id, c4 in rows:
+                try:
+                    values.append(dict(_id=id, _c4=metags.utils.c4decode(c4)))
+                except ValueError:
+                    raise ValueError('Entity {} has an invalid c4 id {!r}'
+                                     .format(id, c4))
+            conn.execute(update, values)
+        for index in table.indexes:
+            if [x.name for x in index.columns] == ['c4']:
+                index.create(conn)
+
+
+# Most parameters allowed in a single statement by older sqlite versions is
+# 999, so large IN clauses are split up.
+_CHUNK_SIZE = 500
+
+
+def _chunks(values, size=_CHUNK_SIZE):
+    """
+    Parameters
+    ----------
+    values : List[Any]
+    size : int
+
+    Returns
+    -------
+    Iterator[List[Any]]
+    """
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def _text(value):
+    return value if isinstance(value, six.string_types) \
+        else six.text_type(value)
@@ -1,8 +1,10 @@
 """
 Memory storage model.
 """
+import os
+import metags.metrics
 from metags.events import event
-from metags.storage.base import AbstractStorageEngine
+from metags.storage.base import AbstractStorageEngine, UPDATE_MODES
 
 from typing import TYPE_CHECKING, Optional, Dict, Any
 
@@ -31,17 +33,113 @@ class MemoryStorageEngine(AbstractStorageEngine):
         -------
         metags.core.Item
         """
-        if item not in self._data:
-            self._data.append(item)
+        with metags.metrics.stage('insert'):
+            if item not in self._data:
+                self._data.append(item)
         return item
 
     def all(self):
         return list(self._data)
 
-    def get(self, c4=None, url=None, metadata=None):
+    def update_meta(self, item, mode='merge'):
+        """
+        Update metadata for the given item.
+
+        Parameters
+        ----------
+        item : metags.core.Item
+        mode : str
+            See `update_meta_many`.
+        """
+        self.update_meta_many([item], mode=mode)
+
+    def update_meta_many(self, items, mode='merge'):
+        """
+        Update metadata for many items. Items which aren't stored are
+        ignored.
+
+        Parameters
+        ----------
+        items : Iterable[metags.core.Item]
+        mode : str
+            'merge' adds the items' metadata to what is stored. 'replace'
+            replaces the stored values of each key the item has, so tagging
+            a key with an empty list removes it. Keys the item doesn't have
+            are left alone either way.
+        """
+        if mode not in UPDATE_MODES:
+            raise ValueError('Unknown update mode {!r}. Expected one of {}'
+                             .format(mode, UPDATE_MODES))
+        for item in items:
+            for stored in self._data:
+                if stored is item or \
+                        (stored.url, stored.c4) != (item.url, item.c4):
+                    continue
+                for key, values in item.metadata.items():
+                    if mode == 'replace':
+                        stored.metadata.pop(key, None)
+                        if values:
+                            stored.metadata[key] = list(values)
+                    else:
+                        existing = stored.metadata.setdefault(key, [])
+                        existing.extend(x for x in values
+                                        if x not in existing)
+
+    def remove(self, url):
+        """
+        Remove the item(s) stored at a url.
+
+        Anything stored below the url, as if it were a directory, is removed
+        as well.
+
+        Parameters
+        ----------
+        url : str
+        """
+        self._data = [x for x in self._data if not _below(x.url, url)]
+
+    def move(self, src, dst):
+        """
+        Change the url of stored item(s) without re-hashing them.
+
+        Anything stored below `src`, as if it were a directory, is moved
+        below `dst`.
+
+        Parameters
+        ----------
+        src : str
+        dst : str
+        """
+        src = src.rstrip(os.sep)
+        dst = dst.rstrip(os.sep)
+        for x in self._data:
+            if _below(x.url, src):
+                x.url = dst + x.url[len(src):]
+
+    def duplicates(self):
+        """
+        Group urls by identical content.
+
+        Returns
+        -------
+        Dict[str, List[str]]
+            Urls keyed by the c4 id they share. Only c4 ids shared by more
+            than one url are included.
+        """
+        import collections
+        results = collections.defaultdict(list)
+        for x in self._data:
+            results[x.c4].append(x.url)
+        return dict((k, sorted(v)) for k, v in results.items() if len(v) > 1)
+
+    def get(self, c4=None, url=None, metadata=None, **kwargs):
         """
         Get `Item`s from either a c4 id, a url or a metadata value(s).
 
+        Metadata may be passed as a dict or as keyword arguments, matching
+        `DatabaseStorageEngine.get`. Like the database engine, metadata
+        logic implements AND logic rather than OR.
+
         Parameters
         ----------
         c4 : Optional[str]
@@ -53,10 +151,34 @@ class MemoryStorageEngine(AbstractStorageEngine):
         List[metags.core.Item]
         """
         import fnmatch
+
+        def match(values, pattern):
+            pattern = str(pattern).replace('%', '*')
+            return any(fnmatch.fnmatchcase(str(x), pattern) for x in values)
+
+        metadata = dict(metadata or {}, **kwargs)
         if c4 is not None:
             return [x for x in self._data if fnmatch.fnmatch(x.c4, c4)]
         elif url is not None:
             return [x for x in self._data if fnmatch.fnmatch(x.url, url)]
-        elif metadata is not None:
-            return [x for x in self._data if any(fnmatch.fnmatch(
-                x.metadata[k], v) for k, v in metadata.items())]
+        elif metadata:
+            results = []
+            for x in self._data:
+                for key, values in metadata.items():
+                    if not isinstance(values, (list, tuple, set)):
+                        values = [values]
+                    keys = [k for k in x.metadata if fnmatch.fnmatchcase(
+                        k, key.replace('%', '*'))]
+                    if not all(any(match(x.metadata[k], v) for k in keys)
+                               for v in values):
+                        break
+                else:
+                    results.append(x)
+            return results
+        else:
+            return self.all()
+
+
+def _below(path, url):
+    url = url.rstrip(os.sep)
+    return path == url or path.startswith(url + os.sep)
@@ -0,0 +1,76 @@
+"""
+Database models.
+
+Kept separate from `metags.storage.database` so sqlalchemy is only imported
+once a database is actually used.
+"""
+import metags.utils
+from sqlalchemy import Column, Integer, Float, String, LargeBinary, \
+    ForeignKey, UniqueConstraint
+from sqlalchemy.orm import relationship
+from sqlalchemy.ext.declarative import declarative_base
+
+
+Base = declarative_base()
+
+
+class Entity(Base):
+    __tablename__ = 'entity'
+    id = Column(Integer, autoincrement=True, primary_key=True)
+    url = Column(String, index=True)
+    # Binary sha512 digest. Use `metags.utils.c4encode` for the c4 id.
+    c4 = Column(LargeBinary(metags.utils.C4_DIGEST_LENGTH), index=True)
+
+    UniqueConstraint(url, c4)
+
+    meta = relationship('LinkMeta')
+
+    def __repr__(self):
+        return '{}(id={!r}, url={!r}, c4={!r})'.format(
+            self.__class__.__name__, self.id, self.url, self.c4)
+
+
+class Meta(Base):
+    __tablename__ = 'meta'
+    id = Column(Integer, autoincrement=True, primary_key=True)
+    content = Column(String, index=True)
+
+
+class LinkMeta(Base):
+    __tablename__ = 'link_meta'
+    id = Column(Integer, autoincrement=True, primary_key=True)
+    entity_id = Column(Integer, ForeignKey(Entity.id))
+    key_id = Column(Integer, ForeignKey(Meta.id))
+    key = relationship(Meta, primaryjoin='LinkMeta.key_id == Meta.id')
+    value_id = Column(Integer, ForeignKey(Meta.id))
+    value = relationship(Meta, primaryjoin='LinkMeta.value_id == Meta.id')
+
+
+class ChangeLog(Base):
+    """
+    Append-only log of changes to entities, read with
+    `DatabaseStorageEngine.changes_since`.
+    """
+    __tablename__ = 'change_log'
+    # sqlite would otherwise reuse the largest seq once it is compacted away
+    __table_args__ = {'sqlite_autoincrement': True}
+    seq = Column(Integer, autoincrement=True, primary_key=True)
+    # No foreign key, as entries outlive removed entities.
+    entity_id = Column(Integer, index=True)
+    url = Column(String)
+    c4 = Column(LargeBinary(metags.utils.C4_DIGEST_LENGTH))
+    operation = Column(String)
+    timestamp = Column(Float)
+
+
+class ShardInfo(Base):
+    """
+    How items are partitioned onto a database when it is one shard of a
+    `metags.storage.sharded.ShardedStorageEngine`. Holds a single row.
+    """
+    __tablename__ = 'shard_info'
+    id = Column(Integer, primary_key=True)
+    # 'c4' or 'url'
+    key = Column(String)
+    shard = Column(Integer)
+    count = Column(Integer)
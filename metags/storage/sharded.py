@@ -0,0 +1,518 @@
+"""
+Sharded storage model.
+
+Partitions items across several database files so writes and queries can
+run against each of them in parallel.
+"""
+import os
+import zlib
+import itertools
+import metags.utils
+from metags.storage.base import AbstractStorageEngine
+from metags.storage.database import DatabaseStorageEngine
+
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterator, List, \
+    Optional, Union
+
+
+if TYPE_CHECKING:
+    import metags.core
+
+
+# Supported partitioning keys.
+KEYS = ('c4', 'url')
+
+
+class ShardedStorageEngine(AbstractStorageEngine):
+    """
+    Storage engine partitioning items across multiple databases.
+
+    Items are routed to a shard either by the leading bytes of their c4
+    digest or by a hash of their url. Each shard records the partitioning
+    key and its position, so reopening shards with a different key or order
+    fails rather than misrouting items. Each shard is only ever accessed
+    from its own worker thread, which keeps sqlite connections and sessions
+    thread-safe.
+    """
+    def __init__(self, dbs, key=None):
+        """
+        Parameters
+        ----------
+        dbs : List[str]
+            Database url of each shard. The order matters as items are
+            routed by index.
+        key : Optional[str]
+            Partition items by either their 'c4' or their 'url'. Defaults to
+            the key the shards were created with, or 'c4' for new shards.
+
+        Raises
+        ------
+        ValueError
+            If the shards were created with a different key, shard count or
+            order.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        if key is not None and key not in KEYS:
+            raise ValueError('Unknown shard key {!r}. Expected one of {}'
+                             .format(key, KEYS))
+        if not dbs:
+            raise ValueError('At least one shard is required.')
+        self.dbs = list(dbs)
+        self._shards = [DatabaseStorageEngine(db) for db in self.dbs]
+        self._executors = [ThreadPoolExecutor(max_workers=1)
+                           for _ in self._shards]
+        try:
+            self.key = self._check_info(key)
+        except Exception:
+            self.close()
+            raise
+
+    def _check_info(self, key):
+        """
+        Compare the partitioning recorded in each shard with the one
+        requested, recording it in shards which don't hold it yet.
+
+        Parameters
+        ----------
+        key : Optional[str]
+
+        Returns
+        -------
+        str
+            Partitioning key.
+        """
+        from metags.storage.models import ShardInfo
+        count = len(self._shards)
+
+        def read(shard):
+            info = shard.session.query(ShardInfo).first()
+            if info is not None:
+                return info.key, info.shard, info.count
+
+        infos = self._map(read)
+        for db, index, info in zip(self.dbs, itertools.count(), infos):
+            if info is not None and info[1:] != (index, count):
+                raise ValueError(
+                    '{} is shard {} of {}, not {} of {}.'.format(
+                        db, info[1], info[2], index, count))
+        stored = set(x[0] for x in infos if x is not None)
+        if len(stored) > 1:
+            raise ValueError('Shards are partitioned by different keys: {}'
+                             .format(sorted(stored)))
+        stored = stored.pop() if stored else None
+        if key is not None and stored is not None and key != stored:
+            raise ValueError(
+                'Shards are partitioned by {!r}, not {!r}. Use rebalance() to '
+                'change the key.'.format(stored, key))
+        key = key or stored or 'c4'
+
+        def write(shard):
+            with shard.transaction() as session:
+                session.add(ShardInfo(
+                    key=key, shard=self._shards.index(shard), count=count))
+
+        self._map(write, [i for i, x in enumerate(infos) if x is None])
+        return key
+
+    @classmethod
+    def from_directory(cls, directory, shards, key=None):
+        """
+        Shard across local sqlite files within a directory.
+
+        Parameters
+        ----------
+        directory : str
+        shards : int
+            Number of shards.
+        key : Optional[str]
+
+        Returns
+        -------
+        ShardedStorageEngine
+
+        Raises
+        ------
+        ValueError
+            If the directory already holds a different number of shards, or
+            shards partitioned by a different key. Use `rebalance` to change
+            either.
+        """
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        existing = [x for x in os.listdir(directory)
+                    if x.startswith('shard_') and x.endswith('.db')]
+        if existing and len(existing) != shards:
+            raise ValueError(
+                '{} holds {} shards, not {}. Use rebalance() to change the '
+                'shard count.'.format(directory, len(existing), shards))
+        return cls(shard_urls(directory, shards), key=key)
+
+    def close(self):
+        """
+        Close each shard and stop the shard worker threads.
+        """
+        self._map(lambda shard: shard.close())
+        for executor in self._executors:
+            executor.shutdown()
+
+    def shard_index(self, item):
+        """
+        Index of the shard an item belongs to.
+
+        Parameters
+        ----------
+        item : metags.core.Item
+
+        Returns
+        -------
+        int
+        """
+        if self.key == 'c4':
+            if not item.c4:
+                item.c4 = item.c4id()
+            return _c4_shard(item.c4, len(self._shards))
+        return _url_shard(item.url, len(self._shards))
+
+    def _map(self, func, indices=None):
+        """
+        Call `func` with each shard on its worker thread.
+
+        Parameters
+        ----------
+        func : Callable[[DatabaseStorageEngine], Any]
+        indices : Optional[List[int]]
+            Shards to call. Defaults to all of them.
+
+        Returns
+        -------
+        List[Any]
+            Results in shard order.
+        """
+        if indices is None:
+            indices = range(len(self._shards))
+        futures = [self._executors[i].submit(func, self._shards[i])
+                   for i in indices]
+        return [x.result() for x in futures]
+
+    def add(self, item):
+        """
+        Store an item.
+
+        Parameters
+        ----------
+        item : metags.core.Item
+
+        Returns
+        -------
+        metags.core.Item
+        """
+        self._map(lambda shard: shard.add(item), [self.shard_index(item)])
+        return item
+
+    def add_many(self, items):
+        """
+        Store many items, adding to each shard in parallel.
+
+        Parameters
+        ----------
+        items : Iterable[metags.core.Item]
+
+        Returns
+        -------
+        List[metags.core.Item]
+        """
+        items = list(items)
+        grouped = {}
+        for item in items:
+            grouped.setdefault(self.shard_index(item), []).append(item)
+
+        def add(shard):
+            shard.add_many(grouped[self._shards.index(shard)])
+
+        self._map(add, sorted(grouped))
+        return items
+
+    def update_meta(self, item, mode='merge'):
+        """
+        Update metadata for the given item.
+
+        Parameters
+        ----------
+        item : metags.core.Item
+        mode : str
+            Either 'merge' or 'replace'.
+        """
+        self._map(lambda shard: shard.update_meta(item, mode=mode),
+                  [self.shard_index(item)])
+
+    def update_meta_many(self, items, mode='merge'):
+        """
+        Update metadata for many items, updating each shard in parallel.
+
+        Parameters
+        ----------
+        items : Iterable[metags.core.Item]
+        mode : str
+            Either 'merge' or 'replace'.
+        """
+        grouped = {}
+        for item in items:
+            grouped.setdefault(self.shard_index(item), []).append(item)
+
+        def update(shard):
+            shard.update_meta_many(
+                grouped[self._shards.index(shard)], mode=mode)
+
+        self._map(update, sorted(grouped))
+
+    def remove(self, url):
+        """
+        Remove the item(s) stored at a url.
+
+        Anything stored below the url, as if it were a directory, is removed
+        as well.
+
+        Parameters
+        ----------
+        url : str
+        """
+        self._map(lambda shard: shard.remove(url))
+
+    def move(self, src, dst):
+        """
+        Change the url of stored item(s) without re-hashing them.
+
+        Anything stored below `src`, as if it were a directory, is moved
+        below `dst`.
+
+        Parameters
+        ----------
+        src : str
+        dst : str
+        """
+        self._map(lambda shard: shard.move(src, dst))
+        if self.key != 'url':
+            return
+
+        # moved items may now belong on another shard
+        def misplaced(shard):
+            index = self._shards.index(shard)
+            items = [x for x in shard.get_tree(dst)
+                     if self.shard_index(x) != index]
+            for item in items:
+                shard.remove(item.url)
+            return items
+
+        self.add_many(itertools.chain.from_iterable(self._map(misplaced)))
+
+    def __iter__(self):
+        for i in range(len(self._shards)):
+            for items in self._pages(i):
+                for item in items:
+                    yield item
+
+    def _pages(self, index, limit=1000):
+        """
+        Stream the items of a shard in batches, reading each batch on the
+        shard's worker thread.
+
+        Parameters
+        ----------
+        index : int
+        limit : int
+
+        Returns
+        -------
+        Iterator[List[metags.core.Item]]
+        """
+        after = 0
+        while after is not None:
+            items, after = self._map(
+                lambda shard: shard.page(after, limit), [index])[0]
+            if items:
+                yield items
+
+    def all(self):
+        """
+        Returns
+        -------
+        List[metags.core.Item]
+        """
+        return list(itertools.chain.from_iterable(
+            self._map(lambda shard: shard.all())))
+
+    def duplicates(self):
+        """
+        Group urls by identical content.
+
+        Returns
+        -------
+        Dict[str, List[str]]
+            Urls keyed by the c4 id they share. Only c4 ids shared by more
+            than one url are included.
+        """
+        if self.key == 'c4':
+            # identical content always lands on the same shard
+            results = {}
+            for shard in self._map(lambda x: x.duplicates()):
+                results.update(shard)
+            return results
+
+        def urls(shard):
+            from metags.storage.models import Entity
+            return shard.session.query(Entity.c4, Entity.url).all()
+
+        grouped = {}
+        for digest, url in itertools.chain.from_iterable(self._map(urls)):
+            grouped.setdefault(digest, []).append(url)
+        return dict((metags.utils.c4encode(k), sorted(v))
+                    for k, v in grouped.items() if len(v) > 1)
+
+    def get(self, c4=None, url=None, order_by=None, **metadata):
+        """
+        Get `Item`s from either a c4 id, a url or metadata value(s).
+
+        Queries are run against all shards concurrently, unless an exact
+        value for the shard key is given, in which case only its shard is
+        queried.
+
+        Parameters
+        ----------
+        c4 : Optional[str]
+        url : Optional[str]
+        order_by : Optional[Union[str, Callable[[metags.core.Item], Any]]]
+            Sort the merged results by an Item attribute name or key
+            function.
+        metadata : Optional[Dict[str, Any]]
+
+        Returns
+        -------
+        List[metags.core.Item]
+        """
+        indices = None
+        if self.key == 'c4' and c4 is not None and not _is_wildcard(c4):
+            try:
+                indices = [_c4_shard(c4, len(self._shards))]
+            except ValueError:
+                return []
+        elif (self.key == 'url' and c4 is None and url is not None and
+                not _is_wildcard(url)):
+            indices = [_url_shard(url, len(self._shards))]
+
+        results = list(itertools.chain.from_iterable(self._map(
+            lambda shard: shard.get(c4=c4, url=url, **metadata), indices)))
+
+        if order_by is not None:
+            if not callable(order_by):
+                import operator
+                order_by = operator.attrgetter(order_by)
+            results.sort(key=order_by)
+        return results
+
+    def rebalance(self, dbs, key=None, batch_size=1000):
+        """
+        Copy all items onto a new set of shards.
+
+        Each shard is streamed in batches, and each batch is written to the
+        new shards with one transaction per shard.
+
+        Parameters
+        ----------
+        dbs : List[str]
+            Database urls of the new shards. These should be empty.
+        key : Optional[str]
+            New partitioning key. Defaults to the current one.
+        batch_size : int
+            Number of items read and written at a time.
+
+        Returns
+        -------
+        ShardedStorageEngine
+        """
+        target = ShardedStorageEngine(dbs, key=key or self.key)
+        for i in range(len(self._shards)):
+            for items in self._pages(i, batch_size):
+                target.add_many(items)
+        return target
+
+
+def shard_urls(directory, shards):
+    """
+    Database urls for sqlite shards within a directory.
+
+    Parameters
+    ----------
+    directory : str
+    shards : int
+
+    Returns
+    -------
+    List[str]
+    """
+    directory = os.path.realpath(directory)
+    return ['sqlite:///' + os.path.join(directory, 'shard_{:03d}.db'.format(i))
+            for i in range(shards)]
+
+
+def rebalance(source, target, shards, key=None):
+    """
+    Copy a directory of sqlite shards into a new directory with a different
+    shard count.
+
+    Parameters
+    ----------
+    source : str
+        Directory holding the existing shards.
+    target : str
+        Directory to write the new shards to. Must not hold any shards.
+    shards : int
+        Number of shards to create.
+    key : Optional[str]
+        Partitioning key of the new shards. Defaults to the key the source
+        shards were created with.
+
+    Returns
+    -------
+    ShardedStorageEngine
+    """
+    existing = sorted(x for x in os.listdir(source)
+                      if x.startswith('shard_') and x.endswith('.db'))
+    if not existing:
+        raise ValueError('{} holds no shards.'.format(source))
+    if os.path.isdir(target) and any(
+            x.startswith('shard_') for x in os.listdir(target)):
+        raise ValueError('{} already holds shards.'.format(target))
+    if not os.path.isdir(target):
+        os.makedirs(target)
+    engine = ShardedStorageEngine(shard_urls(source, len(existing)))
+    try:
+        return engine.rebalance(shard_urls(target, shards), key=key)
+    finally:
+        engine.close()
+
+
+def _is_wildcard(value):
+    return '*' in value or '%' in value
+
+
+def _c4_shard(c4, count):
+    return metags.utils._bytes_to_long(metags.utils.c4decode(c4)[:8]) % count
+
+
+def _url_shard(url, count):
+    if not isinstance(url, bytes):
+        url = url.encode('utf-8')
+    return (zlib.crc32(url) & 0xffffffff) % count
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description='Copy sqlite shards into a new shard count.')
+    parser.add_argument('source')
+    parser.add_argument('target')
+    parser.add_argument('shards', type=int)
+    parser.add_argument('--key', choices=KEYS,
+                        help='Defaults to the key of the source shards.')
+    args = parser.parse_args()
+    rebalance(args.source, args.target, args.shards, key=args.key).close()
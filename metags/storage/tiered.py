@@ -0,0 +1,524 @@
+"""
+Tiered storage model.
+
+Serves repeated lookups from a bounded in-memory tier in front of a
+persistent storage engine.
+"""
+import os
+import bisect
+import collections
+import metags.metrics
+from metags.storage.base import AbstractStorageEngine
+
+from typing import TYPE_CHECKING, Any, Callable, Dict, Hashable, List, \
+    Optional, Tuple
+
+
+if TYPE_CHECKING:
+    import metags.core
+
+
+# Rough per-item overhead in bytes of an Item and its containers, used when
+# estimating the size of cached results.
+_ITEM_OVERHEAD = 512
+
+
+def _sizeof(items):
+    """
+    Estimate the memory used by a list of items.
+
+    Parameters
+    ----------
+    items : List[metags.core.Item]
+
+    Returns
+    -------
+    int
+    """
+    size = 64
+    for item in items:
+        size += _ITEM_OVERHEAD + len(item.url) + len(item.c4 or '')
+        for key, values in item.metadata.items():
+            size += len(key) + sum(len(str(x)) for x in values)
+    return size
+
+
+def _copy(item):
+    """
+    Copy an item so callers can't mutate cached results.
+
+    Parameters
+    ----------
+    item : metags.core.Item
+
+    Returns
+    -------
+    metags.core.Item
+    """
+    metadata = collections.defaultdict(list)
+    for key, values in item.metadata.items():
+        metadata[key] = list(values)
+    return item.__class__(url=item.url, c4=item.c4, metadata=metadata)
+
+
+class LRUCache(object):
+    """
+    Cache bounded by entry count and estimated bytes, evicting the least
+    recently used entries first.
+    """
+    def __init__(self, max_items=10000, max_bytes=None, on_evict=None):
+        """
+        Parameters
+        ----------
+        max_items : Optional[int]
+        max_bytes : Optional[int]
+        on_evict : Optional[Callable[[Hashable, Any], None]]
+            Called with the key and value of each evicted entry.
+        """
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.bytes = 0
+        self._data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def keys(self):
+        return list(self._data)
+
+    def peek(self, key):
+        """
+        Get a cached value without counting it as a use.
+
+        Parameters
+        ----------
+        key : Hashable
+
+        Returns
+        -------
+        Optional[Any]
+            None if the key isn't cached.
+        """
+        entry = self._data.get(key)
+        return None if entry is None else entry[0]
+
+    def get(self, key):
+        """
+        Parameters
+        ----------
+        key : Hashable
+
+        Returns
+        -------
+        Optional[Any]
+            None if the key isn't cached.
+        """
+        try:
+            value, size = self._data.pop(key)
+        except KeyError:
+            return None
+        self._data[key] = (value, size)
+        return value
+
+    def set(self, key, value, size):
+        self.discard(key)
+        self._data[key] = (value, size)
+        self.bytes += size
+        self._evict()
+
+    def discard(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1]
+
+    def clear(self):
+        self._data.clear()
+        self.bytes = 0
+
+    def _full(self):
+        return ((self.max_items is not None and
+                 len(self._data) > self.max_items) or
+                (self.max_bytes is not None and self.bytes > self.max_bytes))
+
+    def _evict(self):
+        while self._data and self._full():
+            key, (value, size) = self._data.popitem(last=False)
+            self.bytes -= size
+            if self.on_evict is not None:
+                self.on_evict(key, value)
+
+
+class LFUCache(LRUCache):
+    """
+    Cache bounded by entry count and estimated bytes, evicting the least
+    frequently used entries first. Ties are broken by recency.
+    """
+    def __init__(self, max_items=10000, max_bytes=None, on_evict=None):
+        super(LFUCache, self).__init__(max_items, max_bytes, on_evict)
+        # entry keys by access count, each in least recently used order
+        self._frequencies = collections.defaultdict(collections.OrderedDict)
+        self._counts = {}
+        self._min = 0
+
+    def _touch(self, key):
+        count = self._counts[key]
+        bucket = self._frequencies[count]
+        del bucket[key]
+        if not bucket:
+            del self._frequencies[count]
+            if self._min == count:
+                self._min = count + 1
+        self._counts[key] = count + 1
+        self._frequencies[count + 1][key] = None
+
+    def get(self, key):
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        self._touch(key)
+        return entry[0]
+
+    def set(self, key, value, size):
+        self.discard(key)
+        self._data[key] = (value, size)
+        self.bytes += size
+        self._counts[key] = 1
+        self._frequencies[1][key] = None
+        self._min = 1
+        self._evict()
+
+    def discard(self, key):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return
+        self.bytes -= entry[1]
+        count = self._counts.pop(key)
+        bucket = self._frequencies[count]
+        del bucket[key]
+        if not bucket:
+            del self._frequencies[count]
+
+    def clear(self):
+        super(LFUCache, self).clear()
+        self._frequencies.clear()
+        self._counts.clear()
+        self._min = 0
+
+    def _evict(self):
+        while self._data and self._full():
+            if self._min not in self._frequencies:
+                self._min = min(self._frequencies)
+            key = next(iter(self._frequencies[self._min]))
+            value = self._data[key][0]
+            self.discard(key)
+            if self.on_evict is not None:
+                self.on_evict(key, value)
+
+
+# Eviction policies by name.
+POLICIES = {
+    'lru': LRUCache,
+    'lfu': LFUCache,
+}
+
+
+class TieredStorageEngine(AbstractStorageEngine):
+    """
+    Storage engine serving exact c4 and url lookups from memory, backed by a
+    persistent storage engine.
+
+    Wildcard and metadata queries always go to the persistent tier.
+    """
+    def __init__(self, persistent, max_items=10000, max_bytes=None,
+                 policy='lru', write_back=False, batch_size=1000):
+        """
+        Parameters
+        ----------
+        persistent : metags.storage.base.AbstractStorageEngine
+        max_items : Optional[int]
+            Maximum number of cached lookups.
+        max_bytes : Optional[int]
+            Maximum estimated size of cached lookups.
+        policy : str
+            Eviction policy. Either 'lru' or 'lfu'.
+        write_back : bool
+            Buffer added items and write them to the persistent tier in
+            batches, rather than immediately. Pending items are written
+            before any read.
+        batch_size : int
+            Number of buffered items which triggers a write when
+            `write_back` is enabled.
+        """
+        if policy not in POLICIES:
+            raise ValueError('Unknown eviction policy {!r}. Expected one of '
+                             '{}'.format(policy, sorted(POLICIES)))
+        self.persistent = persistent
+        self.cache = POLICIES[policy](max_items, max_bytes, self._unindex)
+        # cache keys by each url they hold, and those urls in sorted order
+        # so the ones below a directory can be found without a full scan
+        self._keys = {}
+        self._urls = []
+        self.write_back = write_back
+        self.batch_size = batch_size
+        self._pending = []
+
+    def _index(self, key, items):
+        for url in _urls(key, items):
+            keys = self._keys.get(url)
+            if keys is None:
+                keys = self._keys[url] = set()
+                bisect.insort(self._urls, url)
+            keys.add(key)
+
+    def _unindex(self, key, items):
+        for url in _urls(key, items):
+            keys = self._keys.get(url)
+            if keys is None:
+                continue
+            keys.discard(key)
+            if not keys:
+                del self._keys[url]
+                del self._urls[bisect.bisect_left(self._urls, url)]
+
+    def _discard(self, key):
+        items = self.cache.peek(key)
+        if items is not None:
+            self.cache.discard(key)
+            self._unindex(key, items)
+
+    def _invalidate(self, item):
+        self._discard(('c4', item.c4))
+        self._discard(('url', item.url))
+
+    def _invalidate_tree(self, url):
+        url = url.rstrip(os.sep)
+        keys = set(self._keys.get(url, ()))
+        prefix = url + os.sep
+        i = bisect.bisect_left(self._urls, prefix)
+        while i < len(self._urls) and self._urls[i].startswith(prefix):
+            keys.update(self._keys[self._urls[i]])
+            i += 1
+        for key in keys:
+            self._discard(key)
+
+    def flush(self):
+        """
+        Write any buffered items to the persistent tier.
+        """
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, []
+        add_many = getattr(self.persistent, 'add_many', None)
+        if add_many is not None:
+            add_many(pending)
+        else:
+            for item in pending:
+                self.persistent.add(item)
+
+    def close(self):
+        """
+        Write buffered items and close the persistent tier.
+        """
+        self.flush()
+        close = getattr(self.persistent, 'close', None)
+        if close is not None:
+            close()
+
+    def add(self, item):
+        """
+        Store an item.
+
+        Parameters
+        ----------
+        item : metags.core.Item
+
+        Returns
+        -------
+        metags.core.Item
+        """
+        if not item.c4:
+            item.c4 = item.c4id()
+        self._invalidate(item)
+        if self.write_back:
+            self._pending.append(item)
+            if len(self._pending) >= self.batch_size:
+                self.flush()
+        else:
+            self.persistent.add(item)
+        return item
+
+    def add_many(self, items):
+        """
+        Store many items.
+
+        Parameters
+        ----------
+        items : Iterable[metags.core.Item]
+
+        Returns
+        -------
+        List[metags.core.Item]
+        """
+        return [self.add(x) for x in items]
+
+    def update_meta(self, item, mode='merge'):
+        """
+        Update metadata for the given item.
+
+        Parameters
+        ----------
+        item : metags.core.Item
+        mode : str
+            Either 'merge' or 'replace'.
+        """
+        self.update_meta_many([item], mode=mode)
+
+    def update_meta_many(self, items, mode='merge'):
+        """
+        Update metadata for many items.
+
+        Parameters
+        ----------
+        items : Iterable[metags.core.Item]
+        mode : str
+            Either 'merge' or 'replace'.
+        """
+        items = list(items)
+        self.flush()
+        for item in items:
+            self._invalidate(item)
+        update_meta_many = getattr(self.persistent, 'update_meta_many', None)
+        if update_meta_many is not None:
+            update_meta_many(items, mode=mode)
+        else:
+            for item in items:
+                self.persistent.update_meta(item, mode=mode)
+
+    def remove(self, url):
+        """
+        Remove the item(s) stored at a url.
+
+        Anything stored below the url, as if it were a directory, is removed
+        as well.
+
+        Parameters
+        ----------
+        url : str
+        """
+        self.flush()
+        self._invalidate_tree(url)
+        self.persistent.remove(url)
+
+    def move(self, src, dst):
+        """
+        Change the url of stored item(s) without re-hashing them.
+
+        Anything stored below `src`, as if it were a directory, is moved
+        below `dst`.
+
+        Parameters
+        ----------
+        src : str
+        dst : str
+        """
+        self.flush()
+        self._invalidate_tree(src)
+        self._invalidate_tree(dst)
+        self.persistent.move(src, dst)
+
+    def all(self):
+        """
+        Returns
+        -------
+        List[metags.core.Item]
+        """
+        self.flush()
+        return self.persistent.all()
+
+    def duplicates(self):
+        """
+        Group urls by identical content.
+
+        Returns
+        -------
+        Dict[str, List[str]]
+            Urls keyed by the c4 id they share. Only c4 ids shared by more
+            than one url are included.
+        """
+        self.flush()
+        return self.persistent.duplicates()
+
+    def changes_since(self, seq=0, limit=1000):
+        """
+        Read the persistent tier's change log.
+
+        Parameters
+        ----------
+        seq : int
+        limit : Optional[int]
+
+        Returns
+        -------
+        List[metags.storage.database.Change]
+        """
+        self.flush()
+        return self.persistent.changes_since(seq, limit=limit)
+
+    def get(self, c4=None, url=None, **metadata):
+        """
+        Get `Item`s from either a c4 id, a url or metadata value(s).
+
+        Exact c4 and url lookups are served from memory when cached.
+
+        Parameters
+        ----------
+        c4 : Optional[str]
+        url : Optional[str]
+        metadata : Optional[Dict[str, Any]]
+
+        Returns
+        -------
+        List[metags.core.Item]
+        """
+        key = None
+        if c4 is not None:
+            if not _is_wildcard(c4):
+                key = ('c4', c4)
+        elif url is not None:
+            if not _is_wildcard(url):
+                key = ('url', url)
+
+        if key is None:
+            self.flush()
+            return self.persistent.get(c4=c4, url=url, **metadata)
+
+        items = self.cache.get(key)
+        if items is not None:
+            metags.metrics.counter(
+                metags.metrics.CACHE_REQUESTS_TOTAL, result='hit').inc()
+            return [_copy(x) for x in items]
+
+        metags.metrics.counter(
+            metags.metrics.CACHE_REQUESTS_TOTAL, result='miss').inc()
+        self.flush()
+        items = self.persistent.get(c4=c4, url=url)
+        cached = [_copy(x) for x in items]
+        # indexed first, as setting may evict the entry straight away
+        self._index(key, cached)
+        self.cache.set(key, cached, _sizeof(items))
+        return items
+
+
+def _is_wildcard(value):
+    return '*' in value or '%' in value
+
+
+def _urls(key, items):
+    urls = set(x.url for x in items)
+    if key[0] == 'url':
+        urls.add(key[1])
+    return urls
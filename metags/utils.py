@@ -1,11 +1,36 @@
 import os
 import six
-import hashlib
 from kids.cache import cache
 
 from typing import *
 
 
+_B58CHARS = '123456789abcdefghijkmnopqrstuvwxyzABCDEFGHJKLMNPQRSTUVWXYZ'
+_B58BASE = len(_B58CHARS)
+_B58INDEX = dict((c, i) for i, c in enumerate(_B58CHARS))
+# Number of base58 digits handled per big integer operation. Working in
+# chunks keeps most of the arithmetic on small integers.
+_B58CHUNK_DIGITS = 10
+_B58CHUNK = _B58BASE ** _B58CHUNK_DIGITS
+
+C4_DIGEST_LENGTH = 64
+C4_ID_LENGTH = 90
+_C4_PREFIX = 'c4'
+_C4_MAX = 2 ** (C4_DIGEST_LENGTH * 8) - 1
+
+
+def _bytes_to_long(bytes):
+    if six.PY2:
+        return int(bytes.encode("hex_codec"), 16)
+    return int.from_bytes(bytes, 'big')
+
+
+def _long_to_bytes(value, length):
+    if six.PY2:
+        return ('%0*x' % (length * 2, value)).decode('hex_codec')
+    return value.to_bytes(length, 'big')
+
+
 def _b58encode(bytes):
     """
     Base58 Encode bytes to string
@@ -13,32 +38,128 @@ def _b58encode(bytes):
     Relevant code taken from: 
         https://github.com/Avalanche-io/pyc4
     """
-    __b58chars = '123456789abcdefghijkmnopqrstuvwxyzABCDEFGHJKLMNPQRSTUVWXYZ'
-    __b58base = len(__b58chars)
-    if six.PY2:
-        long_value = int(bytes.encode("hex_codec"), 16)
-    else:
-        long_value = int(bytes.hex(), 16)
+    long_value = _bytes_to_long(bytes)
+
+    digits = []
+    while long_value:
+        long_value, chunk = divmod(long_value, _B58CHUNK)
+        for _ in range(_B58CHUNK_DIGITS):
+            chunk, mod = divmod(chunk, _B58BASE)
+            digits.append(_B58CHARS[mod])
+    digits.reverse()
+
+    return ''.join(digits).lstrip(_B58CHARS[0]) or _B58CHARS[0]
+
+
+def _b58decode(string):
+    """
+    Base58 decode a string to a long.
+
+    Parameters
+    ----------
+    string : str
+
+    Returns
+    -------
+    int
+    """
+    long_value = 0
+    for i in range(0, len(string), _B58CHUNK_DIGITS):
+        chunk = string[i:i + _B58CHUNK_DIGITS]
+        chunk_value = 0
+        for char in chunk:
+            try:
+                chunk_value = chunk_value * _B58BASE + _B58INDEX[char]
+            except KeyError:
+                raise ValueError(
+                    'Invalid base58 character {!r}'.format(char))
+        long_value = long_value * _B58BASE ** len(chunk) + chunk_value
+    return long_value
+
+
+def c4encode(digest):
+    """
+    Encode a binary sha512 digest as a c4 id.
+
+    Parameters
+    ----------
+    digest : bytes
+
+    Returns
+    -------
+    str
+    """
+    b58_hash = _b58encode(digest)
+    # pad with '1's if needed
+    return _C4_PREFIX + b58_hash.rjust(C4_ID_LENGTH - 2, _B58CHARS[0])
 
-    result = ''
-    while long_value >= __b58base:
-        div, mod = divmod(long_value, __b58base)
-        result = __b58chars[mod] + result
-        long_value = div
 
-    result = __b58chars[long_value] + result
+def c4decode(c4id):
+    """
+    Decode a c4 id to its binary sha512 digest.
 
-    return result
+    Parameters
+    ----------
+    c4id : str
+
+    Returns
+    -------
+    bytes
+
+    Raises
+    ------
+    ValueError
+        If `c4id` is not a valid c4 id.
+    """
+    if len(c4id) != C4_ID_LENGTH or not c4id.startswith(_C4_PREFIX):
+        raise ValueError('Invalid c4 id {!r}'.format(c4id))
+    long_value = _b58decode(c4id[2:])
+    if long_value > _C4_MAX:
+        raise ValueError('Invalid c4 id {!r}'.format(c4id))
+    return _long_to_bytes(long_value, C4_DIGEST_LENGTH)
+
+
+def c4range(prefix):
+    """
+    Get the inclusive range of binary digests whose c4 id starts with
+    `prefix`.
+
+    c4 ids are fixed width and zero padded so a prefix always maps onto a
+    contiguous range of digests, which lets prefix searches use an index.
+
+    Parameters
+    ----------
+    prefix : str
+
+    Returns
+    -------
+    Optional[Tuple[bytes, bytes]]
+        None if no c4 id can start with `prefix`.
+    """
+    if not _C4_PREFIX.startswith(prefix[:2]):
+        return None
+    digits = prefix[2:]
+    if len(digits) > C4_ID_LENGTH - 2:
+        return None
+    try:
+        low = _b58decode(digits.ljust(C4_ID_LENGTH - 2, _B58CHARS[0]))
+        high = _b58decode(digits.ljust(C4_ID_LENGTH - 2, _B58CHARS[-1]))
+    except ValueError:
+        return None
+    if low > _C4_MAX:
+        return None
+    return (_long_to_bytes(low, C4_DIGEST_LENGTH),
+            _long_to_bytes(min(high, _C4_MAX), C4_DIGEST_LENGTH))
 
 
 @cache
-def createC4hash(filepath, **kwargs):
+def createC4digest(filepath, **kwargs):
     """
-    Caluculate a c4 hash from a filepath.
-    
+    Caluculate the binary sha512 digest backing a c4 hash from a filepath.
+
     Relevant code taken from: 
         https://github.com/Avalanche-io/pyc4
-    
+
     Parameters
     ----------
     filepath : str 
@@ -47,8 +168,9 @@ def createC4hash(filepath, **kwargs):
 
     Returns
     -------
-    str
+    bytes
     """
+    import hashlib
     sha512_hash = hashlib.sha512()
     with open(filepath, 'r') as f:
         block_size = 100 * (2 ** 20)
@@ -66,19 +188,24 @@ def createC4hash(filepath, **kwargs):
             cnt_blocks = cnt_blocks + 1
         f.close()
 
-    hash_sha512 = sha512_hash.digest()
+    return sha512_hash.digest()
 
-    c4_id_length = 90
-    b58_hash = _b58encode(hash_sha512)
 
-    # pad with '1's if needed
-    padding = ''
-    if len(b58_hash) < (c4_id_length - 2):
-        padding = ('1' * (c4_id_length - 2 - len(b58_hash)))
+def createC4hash(filepath, **kwargs):
+    """
+    Caluculate a c4 hash from a filepath.
+    
+    Parameters
+    ----------
+    filepath : str 
+    kwargs : Dict
+        Unused kwargs for `kids.cache` to re-trigger the hash caluculation.
 
-    # combine to form C4 ID
-    string_id = 'c4' + padding + b58_hash
-    return string_id
+    Returns
+    -------
+    str
+    """
+    return c4encode(createC4digest(filepath, **kwargs))
 
 
 def c4hash(filepath):
@@ -100,15 +227,11 @@ def c4hash(filepath):
 
 
 def tracktime(func):
+    """
+    Decorator recording the duration of calls to `func` as a metric.
 
-    import time
-    import functools
-
-    @functools.wraps(func)
-    def _wrap(*args, **kwargs):
-        start = time.time()
-        results = func(*args, **kwargs)
-        print('{} took {:06f}s'.format(func.__name__, time.time() - start))
-        return results
-
-    return _wrap
+    See `metags.metrics`.
+    """
+    import metags.metrics
+    return metags.metrics.timed(
+        metags.metrics.FUNCTION_SECONDS, function=func.__name__)(func)
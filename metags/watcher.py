@@ -0,0 +1,664 @@
+"""
+Live indexing of a file tree.
+
+A `Watcher` subscribes to changes within a tree, coalesces bursts of them
+into debounced batches and applies each batch through a storage engine.
+Linux's inotify is used where available, falling back to polling the tree
+otherwise or once the watch limit is reached.
+"""
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import threading
+import collections
+import metags.metrics
+
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple, Union
+
+
+if TYPE_CHECKING:
+    import metags.core
+    import metags.factory
+    import metags.rules
+
+
+CREATED = 'created'
+MODIFIED = 'modified'
+DELETED = 'deleted'
+MOVED = 'moved'
+# Stored items may be out of sync with the tree below the path, e.g. after
+# events were dropped.
+RESCAN = 'rescan'
+
+Change = collections.namedtuple('Change', 'kind path dest isdir')
+
+
+class WatchLimitReached(Exception):
+    """
+    Raised when a tree needs more watches than allowed.
+    """
+
+
+# inotify flags. See `man 7 inotify`.
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_ONLYDIR = 0x01000000
+_IN_ISDIR = 0x40000000
+
+_IN_MASK = (_IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE |
+            _IN_DELETE | _IN_DELETE_SELF | _IN_MOVE_SELF | _IN_ONLYDIR)
+
+_IN_EVENT = struct.Struct('iIII')
+
+
+def _below(path, root):
+    return path == root or path.startswith(root + os.sep)
+
+
+def _walk_dirs(path, rules=None):
+    """
+    Walk the directories of a tree, skipping those the rules prune.
+
+    Parameters
+    ----------
+    path : str
+    rules : Optional[metags.rules.Rules]
+
+    Returns
+    -------
+    Iterator[Tuple[str, List[str]]]
+        Directory paths and the names of the files directly within them.
+    """
+    for dirpath, dirnames, filenames in os.walk(path):
+        if rules is not None:
+            dirnames[:] = [x for x in dirnames if not rules.prune(
+                os.path.join(dirpath, x), x)]
+        yield dirpath, filenames
+
+
+class InotifyBackend(object):
+    """
+    Reports changes within a tree using Linux's inotify.
+
+    One watch is needed per directory. Directories pruned by the rules
+    aren't watched.
+    """
+    def __init__(self, root, max_watches=8192, rules=None):
+        """
+        Parameters
+        ----------
+        root : str
+        max_watches : int
+        rules : Optional[metags.rules.Rules]
+
+        Raises
+        ------
+        WatchLimitReached
+            If the tree holds more than `max_watches` directories, or the
+            kernel's watch limit is reached.
+        """
+        import ctypes
+        import ctypes.util
+        self.root = root
+        self.max_watches = max_watches
+        self.rules = rules
+        self._libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+        # watch descriptors to paths and back
+        self._paths = {}
+        self._watches = {}
+        try:
+            self.watch_tree(root)
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _watch(self, path):
+        import ctypes
+        if path in self._watches:
+            return
+        if len(self._watches) >= self.max_watches:
+            raise WatchLimitReached(
+                'More than {} directories to watch'.format(self.max_watches))
+        wd = self._libc.inotify_add_watch(
+            self.fd, path.encode(sys.getfilesystemencoding()), _IN_MASK)
+        if wd < 0:
+            code = ctypes.get_errno()
+            if code == errno.ENOSPC:
+                raise WatchLimitReached(
+                    'The kernel inotify watch limit was reached')
+            if code in (errno.ENOENT, errno.ENOTDIR):
+                # vanished before we got to it
+                return
+            raise OSError(code, os.strerror(code), path)
+        self._paths[wd] = path
+        self._watches[path] = wd
+
+    def watch_tree(self, path):
+        """
+        Watch a directory and every directory below it, unless pruned by
+        the rules.
+
+        Parameters
+        ----------
+        path : str
+        """
+        for dirpath, _ in _walk_dirs(path, self.rules):
+            self._watch(dirpath)
+
+    def _pruned(self, path):
+        return self.rules is not None and path != self.root and \
+            self.rules.prune(path)
+
+    def _unwatch_tree(self, path):
+        for watched in [x for x in self._watches if _below(x, path)]:
+            wd = self._watches.pop(watched)
+            self._paths.pop(wd, None)
+            self._libc.inotify_rm_watch(self.fd, wd)
+
+    def _rename_tree(self, src, dst):
+        for watched in [x for x in self._watches if _below(x, src)]:
+            wd = self._watches.pop(watched)
+            path = dst + watched[len(src):]
+            self._watches[path] = wd
+            self._paths[wd] = path
+
+    def read(self, timeout):
+        """
+        Wait up to `timeout` seconds for changes.
+
+        Parameters
+        ----------
+        timeout : float
+
+        Returns
+        -------
+        List[Change]
+        """
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+
+        changes = []
+        # pending IN_MOVED_FROM indices into changes by cookie
+        moves = {}
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _IN_EVENT.unpack_from(data, offset)
+            offset += _IN_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+
+            if mask & _IN_Q_OVERFLOW:
+                changes.append(Change(RESCAN, self.root, None, True))
+                continue
+            directory = self._paths.get(wd)
+            if directory is None:
+                continue
+            if mask & _IN_IGNORED:
+                self._paths.pop(wd, None)
+                self._watches.pop(directory, None)
+                continue
+
+            path = directory
+            if name:
+                path = os.path.join(
+                    directory, name.decode(sys.getfilesystemencoding()))
+            isdir = bool(mask & _IN_ISDIR)
+
+            if mask & _IN_MOVED_FROM:
+                moves[cookie] = len(changes)
+                changes.append(Change(DELETED, path, None, isdir))
+            elif mask & _IN_MOVED_TO:
+                index = moves.pop(cookie, None)
+                if index is not None:
+                    src = changes[index].path
+                    changes[index] = Change(MOVED, src, path, isdir)
+                    if isdir and self._pruned(path):
+                        self._unwatch_tree(src)
+                    elif isdir:
+                        self._rename_tree(src, path)
+                elif isdir and self._pruned(path):
+                    continue
+                else:
+                    changes.append(Change(CREATED, path, None, isdir))
+                    if isdir:
+                        self.watch_tree(path)
+            elif mask & _IN_CREATE:
+                if isdir and self._pruned(path):
+                    continue
+                changes.append(Change(CREATED, path, None, isdir))
+                if isdir:
+                    self.watch_tree(path)
+            elif mask & _IN_CLOSE_WRITE:
+                changes.append(Change(MODIFIED, path, None, isdir))
+            elif mask & _IN_DELETE:
+                changes.append(Change(DELETED, path, None, isdir))
+            elif mask & (_IN_DELETE_SELF | _IN_MOVE_SELF):
+                if path == self.root:
+                    changes.append(Change(DELETED, path, None, True))
+
+        # directories moved out of the tree are no longer of interest
+        for index in moves.values():
+            if changes[index].isdir:
+                self._unwatch_tree(changes[index].path)
+        return changes
+
+
+class PollingBackend(object):
+    """
+    Reports changes within a tree by periodically comparing stat info.
+
+    Moves are detected by matching inodes. Only files the rules keep are
+    compared, and directories they prune aren't scanned.
+    """
+    def __init__(self, root, interval=5.0, rules=None):
+        """
+        Parameters
+        ----------
+        root : str
+        interval : float
+            Seconds between scans.
+        rules : Optional[metags.rules.Rules]
+        """
+        self.root = root
+        self.interval = interval
+        self.rules = rules
+        self._snapshot = self._scan()
+        self._next = time.time() + interval
+
+    def close(self):
+        pass
+
+    def _scan(self):
+        results = {}
+        for dirpath, filenames in _walk_dirs(self.root, self.rules):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if self.rules is not None and not self.rules.match(path):
+                    continue
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                results[path] = (st.st_ino, st.st_size, st.st_mtime)
+        return results
+
+    def read(self, timeout):
+        """
+        Wait up to `timeout` seconds for changes.
+
+        Parameters
+        ----------
+        timeout : float
+
+        Returns
+        -------
+        List[Change]
+        """
+        remaining = self._next - time.time()
+        if remaining > timeout:
+            time.sleep(timeout)
+            return []
+        if remaining > 0:
+            time.sleep(remaining)
+        self._next = time.time() + self.interval
+
+        old, new = self._snapshot, self._scan()
+        self._snapshot = new
+
+        deleted = set(old) - set(new)
+        inodes = dict((old[x], x) for x in deleted)
+
+        changes = []
+        for path in sorted(set(new) - set(old)):
+            src = inodes.pop(new[path], None)
+            if src is not None:
+                deleted.discard(src)
+                changes.append(Change(MOVED, src, path, False))
+            else:
+                changes.append(Change(CREATED, path, None, False))
+        for path in sorted(deleted):
+            changes.append(Change(DELETED, path, None, False))
+        for path in sorted(set(new) & set(old)):
+            if new[path] != old[path]:
+                changes.append(Change(MODIFIED, path, None, False))
+        return changes
+
+
+def coalesce(changes):
+    """
+    Reduce a sequence of changes to the operations needed to apply them.
+
+    For example, a file created, modified and then deleted only needs
+    deleting and a file moved twice only needs moving once.
+
+    Parameters
+    ----------
+    changes : List[Change]
+
+    Returns
+    -------
+    List[Tuple[str, str, Optional[str]]]
+        Ordered (operation, path, src) tuples. Operations are 'upsert',
+        'delete', 'move', 'move_upsert' and 'rescan'. `src` is only set for
+        moves.
+    """
+    state = collections.OrderedDict()
+
+    for change in changes:
+        path = change.path
+        if change.kind == RESCAN:
+            state.pop(path, None)
+            state[path] = ('rescan', None)
+
+        elif change.kind in (CREATED, MODIFIED):
+            op, src = state.get(path, (None, None))
+            if op in ('move', 'move_upsert'):
+                state[path] = ('move_upsert', src)
+            elif op != 'rescan':
+                state.pop(path, None)
+                state[path] = ('upsert', None)
+
+        elif change.kind == DELETED:
+            op, src = state.pop(path, (None, None))
+            if op in ('move', 'move_upsert'):
+                state.pop(src, None)
+                state[src] = ('delete', None)
+            state[path] = ('delete', None)
+
+        elif change.kind == MOVED:
+            dst = change.dest
+            op, src = state.pop(path, (None, None))
+            if op is None:
+                moved = ('move', path)
+            elif op in ('move', 'move_upsert'):
+                moved = (op, src)
+            else:
+                # content at path changed during this batch
+                state[path] = ('delete', None)
+                moved = ('upsert', None)
+
+            previous, previous_src = state.pop(dst, (None, None))
+            if previous in ('move', 'move_upsert'):
+                state[previous_src] = ('delete', None)
+
+            children = []
+            if change.isdir:
+                children = [(k, v) for k, v in state.items()
+                            if k != path and _below(k, path)]
+                for k, _ in children:
+                    del state[k]
+
+            state[dst] = moved
+            for k, v in children:
+                state[dst + k[len(path):]] = v
+
+    return [(op, path, src) for path, (op, src) in state.items()]
+
+
+class Watcher(object):
+    """
+    Keeps a storage engine in sync with a file tree as it changes.
+    """
+    def __init__(self, factory, filepath, pattern=None, debounce=0.5,
+                 max_delay=10.0, max_watches=8192, poll_interval=5.0,
+                 polling=None):
+        """
+        Parameters
+        ----------
+        factory : metags.factory.FilepathFactory
+        filepath : str
+            Root of the tree to watch.
+        pattern : Union[str, _sre.SRE_Pattern, metags.rules.Rules]
+            Only files whose path matches, or which the rules keep, are
+            stored.
+        debounce : float
+            Seconds without changes before a batch is applied.
+        max_delay : float
+            Maximum seconds a change can wait before its batch is applied.
+        max_watches : int
+            Maximum number of directories to watch with inotify before
+            falling back to polling.
+        poll_interval : float
+            Seconds between scans when polling.
+        polling : Optional[bool]
+            Force polling on or off. By default inotify is used on Linux.
+        """
+        import metags.rules
+        self.factory = factory
+        self.storage = factory.storage
+        self.root = os.path.realpath(filepath)
+        self.rules = metags.rules.as_rules(pattern)
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.max_watches = max_watches
+        self.poll_interval = poll_interval
+
+        self._pending = []
+        self._first = None
+        self._last = None
+        self._stop = threading.Event()
+
+        if polling is None:
+            polling = not sys.platform.startswith('linux')
+        self.backend = None
+        if not polling:
+            try:
+                self.backend = InotifyBackend(self.root, max_watches,
+                                              self.rules)
+            except (WatchLimitReached, OSError, AttributeError):
+                pass
+        if self.backend is None:
+            self.backend = PollingBackend(self.root, poll_interval,
+                                          self.rules)
+
+    def close(self):
+        self.backend.close()
+
+    def _fallback(self):
+        """
+        Switch to polling, rescanning the tree for anything missed.
+        """
+        self.backend.close()
+        self.backend = PollingBackend(self.root, self.poll_interval,
+                                      self.rules)
+        self._queue([Change(RESCAN, self.root, None, True)])
+
+    def _queue(self, changes):
+        now = time.time()
+        self._pending.extend(changes)
+        if self._first is None:
+            self._first = now
+        self._last = now
+        for change in changes:
+            metags.metrics.counter(
+                metags.metrics.WATCH_CHANGES_TOTAL, kind=change.kind).inc()
+
+    def step(self, timeout=None):
+        """
+        Wait for changes, applying the pending batch once it has settled.
+
+        Parameters
+        ----------
+        timeout : Optional[float]
+            Seconds to wait for changes. Defaults to the debounce time.
+
+        Returns
+        -------
+        List[Tuple[str, str, Optional[str]]]
+            Operations applied, if any. See `coalesce`.
+        """
+        try:
+            changes = self.backend.read(
+                self.debounce if timeout is None else timeout)
+        except WatchLimitReached:
+            self._fallback()
+        else:
+            if changes:
+                self._queue(changes)
+
+        if self._pending:
+            now = time.time()
+            if (now - self._last >= self.debounce or
+                    now - self._first >= self.max_delay):
+                return self.flush()
+        return []
+
+    def run(self):
+        """
+        Apply changes until `stop` is called.
+        """
+        self._stop.clear()
+        try:
+            while not self._stop.is_set():
+                self.step()
+            self.flush()
+        finally:
+            self.close()
+
+    def stop(self):
+        self._stop.set()
+
+    def flush(self):
+        """
+        Apply all pending changes.
+
+        Returns
+        -------
+        List[Tuple[str, str, Optional[str]]]
+            Operations applied. See `coalesce`.
+        """
+        ops = coalesce(self._pending)
+        self._pending = []
+        self._first = self._last = None
+        for op, path, src in ops:
+            if op == 'delete':
+                self.storage.remove(path)
+            elif op in ('move', 'move_upsert'):
+                self.storage.remove(path)
+                self.storage.move(src, path)
+                if os.path.isdir(path):
+                    # re-apply the rules below the new location
+                    self._rescan(path)
+                elif op == 'move_upsert' or not self._stored(path):
+                    # the source may never have been stored, e.g. when it
+                    # didn't match the pattern
+                    self._upsert(path)
+                elif not self._matches(path):
+                    self.storage.remove(path)
+            elif op == 'upsert':
+                self._upsert(path)
+            elif op == 'rescan':
+                self._rescan(path)
+        return ops
+
+    def _stored(self, path):
+        if os.path.isdir(path):
+            return bool(self.storage.get(url=path + os.sep + '*'))
+        return any(x.url == path for x in self.storage.get(url=path))
+
+    def _matches(self, path):
+        return self.rules.match(path, root=self.root)
+
+    def _upsert(self, path, stored=None):
+        """
+        Store a file, re-hashing it.
+
+        Parameters
+        ----------
+        path : str
+        stored : Optional[List[metags.core.Item]]
+            Items currently stored at the path, if already known.
+        """
+        if os.path.isdir(path):
+            return self._rescan(path)
+        if not os.path.isfile(path) or not self._matches(path):
+            # only write when something is stored, as most ignored files
+            # never were
+            if stored or (stored is None and self._stored(path)):
+                self.storage.remove(path)
+            return
+        item = self.factory.from_filepath(path)
+        if stored is None:
+            stored = [x for x in self.storage.get(url=path) if x.url == path]
+        if any(x.c4 == item.c4 for x in stored):
+            # refresh stat info without dropping other tags
+            self.storage.update_meta(item, mode='replace')
+        else:
+            self.storage.remove(path)
+            self.storage.add(item)
+
+    def _rescan(self, path):
+        """
+        Reconcile stored items below a path with the tree, only re-hashing
+        files whose stat info changed.
+
+        Parameters
+        ----------
+        path : str
+        """
+        stored = collections.defaultdict(list)
+        for item in self.storage.get(url=path.rstrip(os.sep) + os.sep + '*'):
+            stored[item.url].append(item)
+
+        for url in stored:
+            if not os.path.isfile(url) or not self._matches(url):
+                self.storage.remove(url)
+
+        for dirpath, filenames in _walk_dirs(path, self.rules):
+            for name in filenames:
+                filepath = os.path.join(dirpath, name)
+                if not self._matches(filepath):
+                    continue
+                if not any(_current(x, filepath) for x in stored[filepath]):
+                    self._upsert(filepath, stored=stored[filepath])
+
+
+def _current(item, filepath):
+    """
+    Whether an item's stored stat info still matches the file.
+
+    Parameters
+    ----------
+    item : metags.core.Item
+    filepath : str
+
+    Returns
+    -------
+    bool
+    """
+    import datetime
+    try:
+        statinfo = os.stat(filepath)
+    except OSError:
+        return False
+    mtime = str(datetime.datetime.fromtimestamp(statinfo.st_mtime))
+    size = str(statinfo.st_size)
+    return (mtime in [str(x) for x in item.metadata.get('st_mtime', [])] and
+            size in [str(x) for x in item.metadata.get('st_size', [])])
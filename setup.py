@@ -9,5 +9,6 @@ setup(
     description='Searchable metadata for unique data identified by url.',
     long_description=open('README.md').read(),
     author='Sam Bourne',
-    packages=['metags', 'metags.storage', 'metags.plugins'],
+    packages=['metags', 'metags.storage', 'metags.plugins',
+              'metags.benchmarks'],
 )
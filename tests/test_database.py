@@ -0,0 +1,236 @@
+import sqlite3
+import hashlib
+import pytest
+import metags.core
+import metags.utils
+import metags.storage.database
+
+
+def c4(content):
+    return metags.utils.c4encode(hashlib.sha512(content).digest())
+
+
+def test_upgrade_text_c4(tmp_path):
+    # schema and data as written before c4 ids were stored as digests
+    path = str(tmp_path / 'old.db')
+    conn = sqlite3.connect(path)
+    conn.executescript('''
+        CREATE TABLE entity (
+            id INTEGER NOT NULL, url VARCHAR, c4 VARCHAR,
+            PRIMARY KEY (id), UNIQUE (url, c4));
+        CREATE INDEX ix_entity_url ON entity (url);
+        CREATE TABLE meta (
+            id INTEGER NOT NULL, content VARCHAR, PRIMARY KEY (id));
+        CREATE INDEX ix_meta_content ON meta (content);
+        CREATE TABLE link_meta (
+            id INTEGER NOT NULL, entity_id INTEGER, key_id INTEGER,
+            value_id INTEGER, PRIMARY KEY (id));
+    ''')
+    conn.executemany('INSERT INTO entity (url, c4) VALUES (?, ?)',
+                     [('/a', c4(b'a')), ('/b', c4(b'b')), ('/c', c4(b'a'))])
+    conn.execute("INSERT INTO meta (content) VALUES ('key'), ('value')")
+    conn.execute('INSERT INTO link_meta (entity_id, key_id, value_id) '
+                 'VALUES (1, 1, 2)')
+    conn.commit()
+    conn.close()
+
+    storage = metags.storage.database.DatabaseStorageEngine(
+        'sqlite:///' + path)
+    assert sorted((x.url, x.c4) for x in storage.all()) == [
+        ('/a', c4(b'a')), ('/b', c4(b'b')), ('/c', c4(b'a'))]
+    assert storage.get(url='/a')[0].metadata == {'key': ['value']}
+    assert storage.duplicates() == {c4(b'a'): ['/a', '/c']}
+    storage.close()
+
+    conn = sqlite3.connect(path)
+    assert conn.execute('SELECT DISTINCT typeof(c4) FROM entity')\
+        .fetchall() == [('blob',)]
+    assert conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' "
+                        "AND name = 'ix_entity_c4'").fetchall()
+    conn.close()
+
+
+def test_upgrade_invalid_c4(tmp_path):
+    path = str(tmp_path / 'old.db')
+    conn = sqlite3.connect(path)
+    conn.execute('CREATE TABLE entity (id INTEGER NOT NULL, url VARCHAR, '
+                 'c4 VARCHAR, PRIMARY KEY (id))')
+    conn.execute("INSERT INTO entity (url, c4) VALUES ('/a', 'bogus')")
+    conn.commit()
+    conn.close()
+
+    storage = metags.storage.database.DatabaseStorageEngine(
+        'sqlite:///' + path)
+    with pytest.raises(ValueError):
+        storage.all()
+
+
+def test_add_many_rolls_back_on_error(tmp_path, monkeypatch):
+    storage = metags.storage.database.DatabaseStorageEngine(
+        'sqlite:///' + str(tmp_path / 'test.db'))
+
+    def fail(*args, **kwargs):
+        raise RuntimeError('failed after inserting')
+
+    monkeypatch.setattr(storage, '_update_links', fail)
+    with pytest.raises(RuntimeError):
+        storage.add_many([metags.core.Item(url='/a', c4=c4(b'a'))])
+    storage.close()
+
+    storage = metags.storage.database.DatabaseStorageEngine(
+        'sqlite:///' + str(tmp_path / 'test.db'))
+    assert storage.all() == []
+    assert storage.changes_since(0) == []
+    storage.close()
+
+
+def test_concurrent_writers(tmp_path):
+    db = 'sqlite:///' + str(tmp_path / 'test.db')
+    a = metags.storage.database.DatabaseStorageEngine(db)
+    b = metags.storage.database.DatabaseStorageEngine(db)
+    try:
+        # a read leaves a transaction open on a's connection
+        assert a.all() == []
+        b.add_many([metags.core.Item(url='/b', c4=c4(b'b'))])
+        a.add_many([metags.core.Item(url='/a', c4=c4(b'a'))])
+        assert sorted(x.url for x in b.all()) == ['/a', '/b']
+    finally:
+        a.close()
+        b.close()
+
+
+def make_storage(tmp_path):
+    storage = metags.storage.database.DatabaseStorageEngine(
+        'sqlite:///' + str(tmp_path / 'test.db'))
+    storage.add(metags.core.Item(url='/a', c4=c4(b'a'),
+                                 metadata={'k': ['1', '2'], 'j': ['x']}))
+    return storage
+
+
+def statements(storage):
+    import sqlalchemy.event
+    results = []
+
+    def record(conn, cursor, statement, *args):
+        results.append(statement.strip().upper())
+
+    sqlalchemy.event.listen(storage.session.bind, 'before_cursor_execute',
+                            record)
+    return results
+
+
+def stored_meta(storage):
+    return dict((k, sorted(v))
+                for k, v in storage.get(url='/a')[0].metadata.items())
+
+
+def test_update_meta_many_merge(tmp_path):
+    storage = make_storage(tmp_path)
+    storage.update_meta_many([metags.core.Item(
+        url='/a', c4=c4(b'a'), metadata={'k': ['3'], 'n': ['y']})])
+    assert stored_meta(storage) == {
+        'k': ['1', '2', '3'], 'j': ['x'], 'n': ['y']}
+    storage.close()
+
+
+def test_update_meta_many_replace(tmp_path):
+    storage = make_storage(tmp_path)
+    storage.update_meta_many([metags.core.Item(
+        url='/a', c4=c4(b'a'), metadata={'k': ['2', '3'], 'j': []})],
+        mode='replace')
+    assert stored_meta(storage) == {'k': ['2', '3']}
+    assert [x.operation for x in storage.changes_since(0)] == \
+        ['add', 'update_meta']
+    storage.close()
+
+
+def test_update_meta_many_missing_item(tmp_path):
+    from sqlalchemy.orm.exc import NoResultFound
+    storage = make_storage(tmp_path)
+    with pytest.raises(NoResultFound):
+        storage.update_meta_many([metags.core.Item(url='/b', c4=c4(b'b'))])
+    storage.close()
+
+
+def test_update_meta_many_noop_does_not_write(tmp_path):
+    storage = make_storage(tmp_path)
+    executed = statements(storage)
+    for mode in ('merge', 'replace'):
+        storage.update_meta_many([metags.core.Item(
+            url='/a', c4=c4(b'a'), metadata={'k': ['1', '2']})], mode=mode)
+    assert not [x for x in executed
+                if x.split(None, 1)[0] in ('INSERT', 'UPDATE', 'DELETE')]
+    assert len(storage.changes_since(0)) == 1
+    storage.close()
+
+
+def test_update_meta_many_reads_within_transaction(tmp_path):
+    storage = make_storage(tmp_path)
+    executed = statements(storage)
+    storage.update_meta_many([metags.core.Item(
+        url='/a', c4=c4(b'a'), metadata={'k': ['3']})])
+    # the links are read after the write lock is taken
+    assert executed[0] == 'BEGIN IMMEDIATE'
+    assert any(x.startswith('SELECT LINK_META') for x in executed)
+    storage.close()
+
+
+def test_move_logs_only_moved_entities(tmp_path):
+    storage = metags.storage.database.DatabaseStorageEngine(
+        'sqlite:///' + str(tmp_path / 'test.db'))
+    storage.add(metags.core.Item(url='/d/a', c4=c4(b'a')))
+    storage.add(metags.core.Item(url='/e/b', c4=c4(b'b')))
+    seq = storage.last_change()
+    storage.move('/d', '/e')
+    assert [(x.operation, x.url) for x in storage.changes_since(seq)] == \
+        [('move', '/e/a')]
+    storage.close()
+
+
+def test_changes_since(tmp_path):
+    storage = metags.storage.database.DatabaseStorageEngine(
+        'sqlite:///' + str(tmp_path / 'test.db'))
+    assert storage.last_change() == 0
+    assert storage.changes_since(0) == []
+    for name in ('a', 'b', 'c'):
+        storage.add(metags.core.Item(url='/' + name, c4=c4(name.encode())))
+    storage.remove('/b')
+
+    changes = storage.changes_since(0)
+    assert [(x.operation, x.url) for x in changes] == [
+        ('add', '/a'), ('add', '/b'), ('add', '/c'), ('remove', '/b')]
+    assert [x.seq for x in changes] == sorted(x.seq for x in changes)
+    assert storage.last_change() == changes[-1].seq
+    assert storage.changes_since(changes[0].seq, limit=2) == changes[1:3]
+    assert storage.changes_since(storage.last_change()) == []
+    storage.close()
+
+
+def test_compact_changes(tmp_path):
+    storage = metags.storage.database.DatabaseStorageEngine(
+        'sqlite:///' + str(tmp_path / 'test.db'))
+    storage.add(metags.core.Item(url='/a', c4=c4(b'a')))
+    storage.add(metags.core.Item(url='/b', c4=c4(b'b')))
+    storage.move('/a', '/c')
+    storage.remove('/b')
+    storage.move('/c', '/d')
+    last = storage.last_change()
+
+    # changes from `before` onwards are kept as they are
+    assert storage.compact_changes(before=last) == 2
+    assert [(x.operation, x.url) for x in storage.changes_since(0)] == [
+        ('move', '/c'), ('remove', '/b'), ('move', '/d')]
+
+    assert storage.compact_changes() == 1
+    assert [(x.operation, x.url) for x in storage.changes_since(0)] == [
+        ('remove', '/b'), ('move', '/d')]
+    assert storage.last_change() == last
+
+    assert storage.compact_changes(tombstones=-1) == 1
+    assert [(x.operation, x.url) for x in storage.changes_since(0)] == [
+        ('move', '/d')]
+
+    # seqs aren't reused once compacted away
+    storage.add(metags.core.Item(url='/e', c4=c4(b'e')))
+    assert storage.last_change() == last + 1
+    storage.close()
@@ -0,0 +1,7 @@
+import metags.benchmarks.imports
+
+
+def test_no_heavy_imports():
+    # wall-clock budgets are too noisy for a shared machine, so they are
+    # only reported by `python -m metags.benchmarks.imports`
+    assert metags.benchmarks.imports.check(budgets={}) == []
@@ -0,0 +1,103 @@
+import os
+import pytest
+import metags.factory
+import metags.ingest
+import metags.storage.memory
+from metags.ingest import Journal, Ingest, PENDING, CLAIMED, DONE
+
+
+def write(path, content='data'):
+    with open(str(path), 'w') as f:
+        f.write(content)
+
+
+def make_ingest(tmp_path, **kwargs):
+    storage = metags.storage.memory.MemoryStorageEngine()
+    factory = metags.factory.FilepathFactory(storage)
+    return Ingest(factory, str(tmp_path / 'journal.db'), **kwargs)
+
+
+def test_discovers_subdirectories(tmp_path):
+    root = tmp_path / 'tree'
+    (root / 'a' / 'b').mkdir(parents=True)
+    (root / 'c').mkdir()
+    write(root / 'f')
+    write(root / 'a' / 'f')
+    write(root / 'a' / 'b' / 'f')
+    write(root / 'c' / 'f')
+    ingest = make_ingest(tmp_path)
+
+    ingest.journal.seed(str(root))
+    assert ingest.journal.claim('test') == str(root)
+    assert ingest.process(str(root)) == 1
+    assert ingest.journal.progress() == {PENDING: 2, CLAIMED: 0, DONE: 1}
+
+    assert ingest.run(str(root)) == 3
+    assert ingest.journal.progress() == {PENDING: 0, CLAIMED: 0, DONE: 4}
+    assert sorted(x.url for x in ingest.storage.all()) == sorted(
+        str(x) for x in (root / 'f', root / 'a' / 'f', root / 'a' / 'b' / 'f',
+                         root / 'c' / 'f'))
+
+
+def test_resume_does_not_rehash(tmp_path, monkeypatch):
+    # written files are recorded by their listed path, not the item url
+    # which resolves symlinks
+    (tmp_path / 'data').mkdir()
+    (tmp_path / 'tree').mkdir()
+    for i in range(5):
+        write(tmp_path / 'data' / str(i), str(i))
+        os.symlink(str(tmp_path / 'data' / str(i)),
+                   str(tmp_path / 'tree' / str(i)))
+
+    ingest = make_ingest(tmp_path, batch_size=2)
+    hashed = []
+    from_filepath = ingest.factory.from_filepath
+
+    def spy(path):
+        hashed.append(os.path.basename(path))
+        return from_filepath(path)
+
+    monkeypatch.setattr(ingest.factory, 'from_filepath', spy)
+
+    add = ingest.storage.add
+
+    def interrupt(item):
+        if len(ingest.storage.all()) == 2:
+            raise KeyboardInterrupt
+        add(item)
+
+    monkeypatch.setattr(ingest.storage, 'add', interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        ingest.run(str(tmp_path / 'tree'))
+    ingest.journal.release(ingest.owner)
+    monkeypatch.setattr(ingest.storage, 'add', add)
+
+    written = sorted(hashed[:2])
+    del hashed[:]
+    assert ingest.run(str(tmp_path / 'tree')) == 3
+    assert sorted(hashed) == sorted(set('01234') - set(written))
+    assert len(ingest.storage.all()) == 5
+
+
+def test_claim_takes_over_stale_claims(tmp_path):
+    journal = Journal(str(tmp_path / 'journal.db'))
+    journal.seed('/a')
+    assert journal.claim('first') == '/a'
+    assert journal.claim('second') is None
+    assert journal.claim('second', stale=-1) == '/a'
+    journal.release('first')
+    assert journal.progress()[CLAIMED] == 1
+    journal.close()
+
+
+def test_release_owner(tmp_path):
+    journal = Journal(str(tmp_path / 'journal.db'))
+    journal.discover(['/a', '/b'])
+    assert journal.claim('first') == '/a'
+    assert journal.claim('second') == '/b'
+    journal.release('first')
+    assert journal.progress() == {PENDING: 1, CLAIMED: 1, DONE: 0}
+    assert journal.claim('third') == '/a'
+    journal.release()
+    assert journal.progress() == {PENDING: 2, CLAIMED: 0, DONE: 0}
+    journal.close()
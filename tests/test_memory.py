@@ -0,0 +1,38 @@
+import pytest
+import metags.storage.memory
+from metags.core import Item
+
+
+def make_storage():
+    storage = metags.storage.memory.MemoryStorageEngine()
+    storage.add(Item(url='/a', c4='c4a', metadata={'k': ['1', '2'],
+                                                   'j': ['x']}))
+    return storage
+
+
+def test_update_meta_many_merge():
+    storage = make_storage()
+    storage.update_meta_many([
+        Item(url='/a', c4='c4a', metadata={'k': ['2', '3'], 'n': ['y']})])
+    assert dict(storage.get(url='/a')[0].metadata) == {
+        'k': ['1', '2', '3'], 'j': ['x'], 'n': ['y']}
+
+
+def test_update_meta_many_replace():
+    storage = make_storage()
+    storage.update_meta_many([
+        Item(url='/a', c4='c4a', metadata={'k': ['3'], 'j': []})],
+        mode='replace')
+    assert dict(storage.get(url='/a')[0].metadata) == {'k': ['3']}
+
+
+def test_update_meta_many_ignores_missing_items():
+    storage = make_storage()
+    storage.update_meta_many([Item(url='/b', c4='c4b', metadata={'k': ['1']}),
+                              Item(url='/a', c4='c4b', metadata={'k': ['1']})])
+    assert [x.url for x in storage.all()] == ['/a']
+
+
+def test_update_meta_many_unknown_mode():
+    with pytest.raises(ValueError):
+        make_storage().update_meta_many([], mode='append')
@@ -0,0 +1,109 @@
+import json
+import pytest
+import metags.events
+import metags.metrics
+
+
+@pytest.fixture
+def metrics():
+    enabled = metags.metrics.enabled()
+    metags.metrics.reset()
+    metags.metrics.enable()
+    yield metags.metrics
+    metags.metrics.reset()
+    if not enabled:
+        metags.metrics.disable()
+
+
+def test_disabled_metrics_are_not_collected():
+    metags.metrics.disable()
+    metags.metrics.reset()
+    metags.metrics.counter('test_total').inc()
+    with metags.metrics.stage('walk'):
+        pass
+    assert metags.metrics.snapshot() == {}
+    assert metags.metrics.to_prometheus() == ''
+
+
+def test_counter(metrics):
+    metrics.counter('test_total', kind='a').inc()
+    metrics.counter('test_total', kind='a').inc(2)
+    metrics.counter('test_total', kind='b').inc()
+    assert metrics.snapshot() == {'test_total': [
+        {'type': 'counter', 'labels': {'kind': 'a'}, 'value': 3},
+        {'type': 'counter', 'labels': {'kind': 'b'}, 'value': 1},
+    ]}
+
+
+def test_histogram(metrics):
+    histogram = metrics.histogram('test_seconds')
+    for value in (0.5, 1, 2, 20):
+        histogram.observe(value)
+    assert histogram.count == 4
+    assert histogram.sum == 23.5
+    assert histogram.cumulative()[-4:] == [
+        (1.0, 2), (5.0, 3), (10.0, 3), (float('inf'), 4)]
+    sample = metrics.snapshot()['test_seconds'][0]
+    assert sample['buckets'][-1] == ['+Inf', 4]
+
+
+def test_stage_and_timed(metrics):
+    with metrics.stage('walk'):
+        pass
+
+    @metrics.timed('test_seconds', function='func')
+    def func(x):
+        return x * 2
+
+    assert func(2) == 4
+    assert func(3) == 6
+    snapshot = metrics.snapshot()
+    assert [(x['labels'], x['count'])
+            for x in snapshot[metrics.STAGE_SECONDS]] == \
+        [({'stage': 'walk'}, 1)]
+    assert [(x['labels'], x['count'])
+            for x in snapshot['test_seconds']] == [({'function': 'func'}, 2)]
+
+
+def test_to_json(metrics):
+    metrics.counter('test_total').inc()
+    assert json.loads(metrics.to_json()) == metrics.snapshot()
+
+
+def test_to_prometheus(metrics):
+    metrics.counter('test_total', path='a"b\\c').inc()
+    histogram = metrics.histogram('test_seconds')
+    histogram.buckets = (1.0,)
+    histogram.counts = [0, 0]
+    histogram.observe(0.5)
+    histogram.observe(2)
+    assert metrics.to_prometheus() == (
+        '# TYPE test_seconds histogram\n'
+        'test_seconds_bucket{le="1.0"} 1\n'
+        'test_seconds_bucket{le="+Inf"} 2\n'
+        'test_seconds_sum 2.5\n'
+        'test_seconds_count 2\n'
+        '# TYPE test_total counter\n'
+        'test_total{path="a\\"b\\\\c"} 1\n')
+
+
+def test_emit_times_listeners(metrics, monkeypatch):
+    results = []
+    monkeypatch.setitem(metags.events._events, 'test', [results.append])
+    metags.events.emit('test', 1)
+    assert results == [1]
+    samples = metrics.snapshot()[metrics.EVENT_LISTENER_SECONDS]
+    assert [(x['labels']['event'], x['count']) for x in samples] == \
+        [('test', 1)]
+
+
+def test_emit_skips_metrics_when_disabled(monkeypatch):
+    def fail(func):
+        raise AssertionError('listener name built while disabled')
+
+    metags.metrics.disable()
+    results = []
+    monkeypatch.setattr(metags.events, '_listener_name', fail)
+    monkeypatch.setitem(metags.events._events, 'test', [results.append])
+    metags.events.emit('test', 1)
+    assert results == [1]
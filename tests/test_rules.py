@@ -0,0 +1,145 @@
+import os
+import metags.factory
+import metags.rules
+import metags.storage.memory
+from metags.rules import Rules, include, exclude
+
+
+def touch(path):
+    open(str(path), 'w').close()
+
+
+def test_inline_flags():
+    rules = Rules.from_pattern(r'(?i).*\.png')
+    assert rules.match('/a/b.PNG')
+    assert not rules.match('/a/b.exr')
+
+
+def test_inline_flags_among_other_rules():
+    rules = Rules([
+        exclude('*_backup.*'),
+        include(r'(?i).*\.png', regex=True),
+        include(r'(?i).*\.exr', regex=True),
+        include('*.jpg'),
+    ], default=False)
+    assert rules.match('/a/b.PNG')
+    assert rules.match('/a/b.Exr')
+    assert rules.match('/a/b.jpg')
+    assert not rules.match('/a/b_backup.png')
+    assert not rules.match('/a/b.JPG')
+
+
+def test_generate_with_inline_flags(tmp_path):
+    touch(tmp_path / 'a.PNG')
+    touch(tmp_path / 'b.exr')
+    factory = metags.factory.FilepathFactory(
+        metags.storage.memory.MemoryStorageEngine())
+    items = factory.generate_syncronously(str(tmp_path), r'(?i).*\.png')
+    assert [os.path.basename(x.url) for x in items] == ['a.PNG']
+
+
+def test_excluded_directories_are_not_listed(tmp_path, monkeypatch):
+    (tmp_path / '.git' / 'objects').mkdir(parents=True)
+    (tmp_path / 'd' / 'tmp').mkdir(parents=True)
+    touch(tmp_path / '.git' / 'a')
+    touch(tmp_path / 'd' / 'tmp' / 'a')
+    touch(tmp_path / 'd' / 'a')
+    rules = Rules([exclude('.git', directory=True),
+                   exclude(os.path.join(str(tmp_path), 'd', 'tmp'),
+                           directory=True)])
+    listed = []
+    scandir = os.scandir
+
+    def spy(path):
+        listed.append(path)
+        return scandir(path)
+
+    monkeypatch.setattr(os, 'scandir', spy)
+    assert list(rules.walk(str(tmp_path))) == [str(tmp_path / 'd' / 'a')]
+    assert sorted(listed) == [str(tmp_path), str(tmp_path / 'd')]
+
+    assert rules.prune(str(tmp_path / 'x' / '.git'))
+    assert not rules.match(str(tmp_path / '.git' / 'a'), root=str(tmp_path))
+    assert rules.match(str(tmp_path / '.git' / 'a'))
+
+
+def test_first_match_decides():
+    rules = Rules([
+        exclude('*_backup.*'),
+        include('*.png'),
+        exclude('*'),
+    ])
+    assert rules.match('/a/b.png')
+    assert not rules.match('/a/b_backup.png')
+    assert not rules.match('/a/b.exr')
+
+    rules = Rules([include('*.png'), exclude('*_backup.*')])
+    assert rules.match('/a/b_backup.png')
+    assert not rules.match('/a/b_backup.exr')
+    assert rules.match('/a/b.exr')
+
+
+def test_default():
+    assert Rules().match('/a/b')
+    assert not Rules(default=False).match('/a/b')
+    assert Rules([include('*.png')], default=False).match('/a/b.png')
+
+
+def test_path_globs_match_the_whole_path():
+    rules = Rules([include(os.path.join(os.sep, 'a', '*.png'))],
+                  default=False)
+    assert rules.match(os.path.join(os.sep, 'a', 'b.png'))
+    assert not rules.match(os.path.join(os.sep, 'b', 'b.png'))
+
+
+def test_extensions():
+    rules = Rules(extensions=['png', '.EXR'])
+    assert rules.match('/a/b.PNG')
+    assert rules.match('/a/b.exr')
+    assert not rules.match('/a/b.jpg')
+    assert not rules.match('/a/png')
+
+
+def test_size_and_time_prefilters(tmp_path):
+    small = tmp_path / 'small'
+    large = tmp_path / 'large'
+    with open(str(small), 'w') as f:
+        f.write('x')
+    with open(str(large), 'w') as f:
+        f.write('x' * 100)
+    os.utime(str(small), (1000, 1000))
+    os.utime(str(large), (2000, 2000))
+
+    assert [x for x in (small, large)
+            if Rules(min_size=10).match(str(x))] == [large]
+    assert [x for x in (small, large)
+            if Rules(max_size=10).match(str(x))] == [small]
+    assert [x for x in (small, large)
+            if Rules(newer=1500).match(str(x))] == [large]
+    assert [x for x in (small, large)
+            if Rules(older=1500).match(str(x))] == [small]
+    assert not Rules(min_size=1).match(str(tmp_path / 'missing'))
+    assert sorted(Rules(min_size=10).walk(str(tmp_path))) == [str(large)]
+
+
+def test_stat_is_skipped_without_prefilters(tmp_path, monkeypatch):
+    touch(tmp_path / 'a')
+    stat = os.stat
+
+    def spy(path, *args, **kwargs):
+        assert not str(path).endswith(os.sep + 'a')
+        return stat(path, *args, **kwargs)
+
+    monkeypatch.setattr(os, 'stat', spy)
+    assert Rules([include('a')]).match(str(tmp_path / 'a'))
+
+
+def test_as_rules():
+    import re
+    rules = Rules()
+    assert metags.rules.as_rules(rules) is rules
+    assert metags.rules.as_rules(None).match('/a/b')
+    assert metags.rules.as_rules(r'.*\.png').match('/a/b.png')
+    assert not metags.rules.as_rules(r'.*\.png').match('/a/b.PNG')
+    assert metags.rules.as_rules(re.compile(r'.*\.png', re.I)).match(
+        '/a/b.PNG')
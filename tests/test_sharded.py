@@ -0,0 +1,141 @@
+import hashlib
+import pytest
+import metags.utils
+import metags.storage.sharded
+from metags.core import Item
+
+
+def c4(content):
+    return metags.utils.c4encode(hashlib.sha512(content.encode()).digest())
+
+
+def snapshot(storage):
+    return sorted((x.url, x.c4, sorted((k, sorted(v))
+                                       for k, v in x.metadata.items()))
+                  for x in storage.all())
+
+
+def test_rebalance(tmp_path):
+    source = metags.storage.sharded.ShardedStorageEngine.from_directory(
+        str(tmp_path / 'a'), 3)
+    source.add_many(Item(url='/f/{}'.format(i), c4=c4(str(i % 70)),
+                         metadata={'k': ['v{}'.format(i % 5)],
+                                   'n': [str(i)]})
+                    for i in range(250))
+    source.close()
+
+    target = metags.storage.sharded.rebalance(
+        str(tmp_path / 'a'), str(tmp_path / 'b'), 5)
+    source = metags.storage.sharded.ShardedStorageEngine.from_directory(
+        str(tmp_path / 'a'), 3)
+    try:
+        assert len(target.all()) == 250
+        assert snapshot(target) == snapshot(source)
+        assert target.duplicates() == source.duplicates()
+    finally:
+        source.close()
+        target.close()
+
+
+def make(tmp_path, key=None, shards=4):
+    return metags.storage.sharded.ShardedStorageEngine.from_directory(
+        str(tmp_path / 'shards'), shards, key=key)
+
+
+def items(count=20):
+    return [Item(url='/d/f{}'.format(i), c4=c4(str(i)),
+                 metadata={'k': ['v{}'.format(i % 2)]})
+            for i in range(count)]
+
+
+def spy_get(storage, monkeypatch):
+    queried = []
+    for i, shard in enumerate(storage._shards):
+        def get(index=i, original=shard.get, **kwargs):
+            queried.append(index)
+            return original(**kwargs)
+        monkeypatch.setattr(shard, 'get', get)
+    return queried
+
+
+def test_get_fans_out(tmp_path):
+    storage = make(tmp_path)
+    try:
+        storage.add_many(items())
+        assert len(set(storage.shard_index(x) for x in items())) > 1
+        assert sorted(x.url for x in storage.get(k='v1')) == sorted(
+            '/d/f{}'.format(i) for i in range(1, 20, 2))
+        assert len(storage.get(url='/d/*')) == 20
+    finally:
+        storage.close()
+
+
+def test_get_exact_key_queries_one_shard(tmp_path, monkeypatch):
+    for key in ('c4', 'url'):
+        storage = make(tmp_path / key, key=key)
+        try:
+            storage.add_many(items())
+            item = items()[7]
+            queried = spy_get(storage, monkeypatch)
+            value = {'c4': dict(c4=item.c4), 'url': dict(url=item.url)}[key]
+            assert [x.url for x in storage.get(**value)] == [item.url]
+            assert queried == [storage.shard_index(item)]
+        finally:
+            storage.close()
+
+
+def test_get_order_by(tmp_path):
+    storage = make(tmp_path)
+    try:
+        storage.add_many(items())
+        expected = sorted(x.url for x in items())
+        assert [x.url for x in storage.get(url='/d/*', order_by='url')] == \
+            expected
+        assert [x.url for x in storage.get(
+            url='/d/*', order_by=lambda x: x.url)] == expected
+    finally:
+        storage.close()
+
+
+def test_move_by_url_reroutes_items(tmp_path):
+    storage = make(tmp_path, key='url')
+    try:
+        storage.add_many(items())
+        storage.move('/d', '/e')
+        assert sorted(x.url for x in storage.all()) == sorted(
+            '/e/f{}'.format(i) for i in range(20))
+        shards = storage._map(lambda shard: shard.all())
+        for i, shard in enumerate(shards):
+            assert all(storage.shard_index(x) == i for x in shard)
+        assert [x.url for x in storage.get(url='/e/f3')] == ['/e/f3']
+    finally:
+        storage.close()
+
+
+def test_key_is_recorded(tmp_path):
+    make(tmp_path, key='url').close()
+    storage = make(tmp_path)
+    try:
+        assert storage.key == 'url'
+    finally:
+        storage.close()
+    with pytest.raises(ValueError):
+        make(tmp_path, key='c4')
+    with pytest.raises(ValueError):
+        metags.storage.sharded.ShardedStorageEngine(
+            metags.storage.sharded.shard_urls(str(tmp_path / 'shards'),
+                                              4)[::-1])
+
+
+def test_rebalance_keeps_key(tmp_path):
+    source = make(tmp_path, key='url')
+    source.add_many(items())
+    source.close()
+    target = metags.storage.sharded.rebalance(
+        str(tmp_path / 'shards'), str(tmp_path / 'b'), 3)
+    try:
+        assert target.key == 'url'
+        assert len(target.all()) == 20
+        assert [x.url for x in target.get(url='/d/f0')] == ['/d/f0']
+    finally:
+        target.close()
@@ -0,0 +1,57 @@
+import hashlib
+import metags.utils
+import metags.storage.memory
+import metags.storage.tiered
+from metags.core import Item
+
+
+def c4(content):
+    return metags.utils.c4encode(hashlib.sha512(content.encode()).digest())
+
+
+def make_storage(policy, max_items):
+    persistent = metags.storage.memory.MemoryStorageEngine()
+    for i in range(200):
+        persistent.add(Item(url='/d{}/f{}'.format(i % 10, i),
+                            c4=c4(str(i % 50))))
+    return metags.storage.tiered.TieredStorageEngine(
+        persistent, max_items=max_items, policy=policy)
+
+
+def check_index(storage):
+    assert storage._urls == sorted(storage._keys)
+    for key in storage.cache.keys():
+        for url in metags.storage.tiered._urls(key, storage.cache.peek(key)):
+            assert key in storage._keys[url]
+    for keys in storage._keys.values():
+        assert all(key in storage.cache for key in keys)
+
+
+def test_index_follows_evictions():
+    for policy in metags.storage.tiered.POLICIES:
+        storage = make_storage(policy, max_items=20)
+        for i in range(0, 200, 3):
+            storage.get(url='/d{}/f{}'.format(i % 10, i))
+            storage.get(c4=c4(str(i % 50)))
+        assert len(storage.cache) == 20
+        check_index(storage)
+
+
+def test_remove_and_move_invalidate_below_directory():
+    storage = make_storage('lru', max_items=1000)
+    for i in range(200):
+        storage.get(url='/d{}/f{}'.format(i % 10, i))
+        storage.get(c4=c4(str(i % 50)))
+
+    storage.remove('/d1')
+    check_index(storage)
+    assert not any(x.url.startswith('/d1/') for key in storage.cache.keys()
+                   for x in storage.cache.peek(key))
+    assert storage.get(url='/d1/f1') == []
+
+    storage.move('/d2', '/e2')
+    check_index(storage)
+    assert storage.get(url='/d2/f2') == []
+    assert [x.url for x in storage.get(url='/e2/f2')] == ['/e2/f2']
+    assert sorted(x.url for x in storage.get(c4=c4('2'))) == \
+        ['/e2/f102', '/e2/f152', '/e2/f2', '/e2/f52']
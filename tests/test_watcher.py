@@ -0,0 +1,333 @@
+import os
+import sys
+import time
+import pytest
+import metags.factory
+import metags.rules
+import metags.watcher
+import metags.storage.memory
+from metags.watcher import Change, CREATED, MODIFIED, DELETED, MOVED, \
+    RESCAN, coalesce
+
+
+linux = pytest.mark.skipif(not sys.platform.startswith('linux'),
+                           reason='inotify is only available on Linux')
+
+
+def write(path, content='data'):
+    with open(str(path), 'w') as f:
+        f.write(content)
+
+
+def read_all(backend, settle=0.2, timeout=5.0):
+    """
+    Read changes until none arrive for `settle` seconds.
+    """
+    changes = []
+    end = time.time() + timeout
+    while time.time() < end:
+        batch = backend.read(settle)
+        if not batch and changes:
+            break
+        changes.extend(batch)
+    return changes
+
+
+# coalesce
+
+
+def test_coalesce_create_then_delete():
+    assert coalesce([
+        Change(CREATED, '/a', None, False),
+        Change(MODIFIED, '/a', None, False),
+        Change(DELETED, '/a', None, False),
+    ]) == [('delete', '/a', None)]
+
+
+def test_coalesce_move_then_move():
+    assert coalesce([
+        Change(MOVED, '/a', '/b', False),
+        Change(MOVED, '/b', '/c', False),
+    ]) == [('move', '/c', '/a')]
+
+
+def test_coalesce_move_then_modify():
+    assert coalesce([
+        Change(MOVED, '/a', '/b', False),
+        Change(MODIFIED, '/b', None, False),
+    ]) == [('move_upsert', '/b', '/a')]
+
+
+def test_coalesce_move_then_delete():
+    assert coalesce([
+        Change(MOVED, '/a', '/b', False),
+        Change(DELETED, '/b', None, False),
+    ]) == [('delete', '/a', None), ('delete', '/b', None)]
+
+
+def test_coalesce_create_then_move():
+    assert coalesce([
+        Change(CREATED, '/a', None, False),
+        Change(MOVED, '/a', '/b', False),
+    ]) == [('delete', '/a', None), ('upsert', '/b', None)]
+
+
+def test_coalesce_directory_move_carries_children():
+    assert coalesce([
+        Change(CREATED, '/d/new', None, False),
+        Change(MOVED, '/d/x', '/d/y', False),
+        Change(MOVED, '/d', '/e', True),
+    ]) == [('move', '/e', '/d'),
+           ('upsert', '/e/new', None),
+           ('move', '/e/y', '/d/x')]
+
+
+def test_coalesce_rescan_absorbs_changes():
+    assert coalesce([
+        Change(RESCAN, '/d', None, True),
+        Change(MODIFIED, '/d', None, True),
+    ]) == [('rescan', '/d', None)]
+
+
+# PollingBackend
+
+
+def test_polling_detects_moves_by_inode(tmp_path):
+    write(tmp_path / 'a')
+    backend = metags.watcher.PollingBackend(str(tmp_path), interval=0)
+    os.rename(str(tmp_path / 'a'), str(tmp_path / 'b'))
+    assert backend.read(0) == [
+        Change(MOVED, str(tmp_path / 'a'), str(tmp_path / 'b'), False)]
+
+
+def test_polling_detects_create_modify_delete(tmp_path):
+    write(tmp_path / 'a')
+    write(tmp_path / 'b')
+    backend = metags.watcher.PollingBackend(str(tmp_path), interval=0)
+    os.remove(str(tmp_path / 'a'))
+    write(tmp_path / 'b', 'longer data')
+    write(tmp_path / 'c')
+    assert backend.read(0) == [
+        Change(CREATED, str(tmp_path / 'c'), None, False),
+        Change(DELETED, str(tmp_path / 'a'), None, False),
+        Change(MODIFIED, str(tmp_path / 'b'), None, False),
+    ]
+
+
+def test_polling_skips_pruned_and_ignored_files(tmp_path):
+    (tmp_path / '.git').mkdir()
+    rules = metags.rules.Rules([
+        metags.rules.exclude('.git', directory=True),
+        metags.rules.include('*.png'),
+    ], default=False)
+    backend = metags.watcher.PollingBackend(str(tmp_path), interval=0,
+                                            rules=rules)
+    write(tmp_path / '.git' / 'a.png')
+    write(tmp_path / 'a.txt')
+    write(tmp_path / 'a.png')
+    assert backend.read(0) == [
+        Change(CREATED, str(tmp_path / 'a.png'), None, False)]
+
+
+# InotifyBackend
+
+
+@linux
+def test_inotify_file_move(tmp_path):
+    write(tmp_path / 'a')
+    backend = metags.watcher.InotifyBackend(str(tmp_path))
+    try:
+        os.rename(str(tmp_path / 'a'), str(tmp_path / 'b'))
+        assert read_all(backend) == [
+            Change(MOVED, str(tmp_path / 'a'), str(tmp_path / 'b'), False)]
+    finally:
+        backend.close()
+
+
+@linux
+def test_inotify_directory_move(tmp_path):
+    (tmp_path / 'd').mkdir()
+    write(tmp_path / 'd' / 'a')
+    backend = metags.watcher.InotifyBackend(str(tmp_path))
+    try:
+        os.rename(str(tmp_path / 'd'), str(tmp_path / 'e'))
+        assert read_all(backend) == [
+            Change(MOVED, str(tmp_path / 'd'), str(tmp_path / 'e'), True)]
+
+        # the directory's watch follows it
+        write(tmp_path / 'e' / 'b')
+        changes = read_all(backend)
+        assert Change(CREATED, str(tmp_path / 'e' / 'b'), None, False) \
+            in changes
+    finally:
+        backend.close()
+
+
+@linux
+def test_inotify_replace_by_rename(tmp_path):
+    write(tmp_path / 'a', 'old')
+    backend = metags.watcher.InotifyBackend(str(tmp_path))
+    try:
+        write(tmp_path / 'a.tmp', 'new')
+        os.rename(str(tmp_path / 'a.tmp'), str(tmp_path / 'a'))
+        changes = read_all(backend)
+        assert changes[-1] == Change(
+            MOVED, str(tmp_path / 'a.tmp'), str(tmp_path / 'a'), False)
+        assert coalesce(changes) == [('delete', str(tmp_path / 'a.tmp'), None),
+                                     ('upsert', str(tmp_path / 'a'), None)]
+    finally:
+        backend.close()
+
+
+@linux
+def test_inotify_skips_pruned_directories(tmp_path):
+    (tmp_path / '.git' / 'objects').mkdir(parents=True)
+    (tmp_path / 'd').mkdir()
+    rules = metags.rules.Rules(
+        [metags.rules.exclude('.git', directory=True)])
+    backend = metags.watcher.InotifyBackend(str(tmp_path), rules=rules)
+    try:
+        assert sorted(backend._watches) == [str(tmp_path),
+                                            str(tmp_path / 'd')]
+        (tmp_path / 'd' / '.git').mkdir()
+        write(tmp_path / 'd' / '.git' / 'a')
+        write(tmp_path / 'd' / 'a')
+        assert read_all(backend) == [
+            Change(CREATED, str(tmp_path / 'd' / 'a'), None, False),
+            Change(MODIFIED, str(tmp_path / 'd' / 'a'), None, False)]
+        assert str(tmp_path / 'd' / '.git') not in backend._watches
+    finally:
+        backend.close()
+
+
+@linux
+def test_inotify_watch_limit(tmp_path):
+    (tmp_path / 'd').mkdir()
+    with pytest.raises(metags.watcher.WatchLimitReached):
+        metags.watcher.InotifyBackend(str(tmp_path), max_watches=1)
+
+
+# Watcher
+
+
+def make_watcher(tmp_path, pattern=None, **kwargs):
+    storage = metags.storage.memory.MemoryStorageEngine()
+    factory = metags.factory.FilepathFactory(storage)
+    factory.add(str(tmp_path), pattern=pattern)
+    return metags.watcher.Watcher(factory, str(tmp_path), pattern=pattern,
+                                  debounce=0, **kwargs)
+
+
+@linux
+def test_watcher_replace_by_rename(tmp_path):
+    write(tmp_path / 'a', 'old')
+    watcher = make_watcher(tmp_path)
+    try:
+        old = watcher.storage.get(url=str(tmp_path / 'a'))[0].c4
+        write(tmp_path / 'a.tmp', 'new')
+        os.rename(str(tmp_path / 'a.tmp'), str(tmp_path / 'a'))
+        watcher._queue(read_all(watcher.backend))
+        watcher.flush()
+        items = watcher.storage.all()
+        assert [x.url for x in items] == [str(tmp_path / 'a')]
+        assert items[0].c4 != old
+    finally:
+        watcher.close()
+
+
+def test_watcher_move_of_unstored_file(tmp_path):
+    write(tmp_path / 'a', 'old')
+    watcher = make_watcher(tmp_path, polling=True)
+    try:
+        # e.g. the temporary file was written before the last batch
+        write(tmp_path / 'a.tmp', 'new')
+        os.rename(str(tmp_path / 'a.tmp'), str(tmp_path / 'a'))
+        watcher._queue([Change(MOVED, str(tmp_path / 'a.tmp'),
+                               str(tmp_path / 'a'), False)])
+        watcher.flush()
+        assert [x.url for x in watcher.storage.all()] == \
+            [str(tmp_path / 'a')]
+    finally:
+        watcher.close()
+
+
+def test_watcher_move_to_unmatched_name(tmp_path):
+    write(tmp_path / 'a.png')
+    watcher = make_watcher(tmp_path, pattern=r'.*\.png', polling=True)
+    try:
+        assert len(watcher.storage.all()) == 1
+        os.rename(str(tmp_path / 'a.png'), str(tmp_path / 'c.txt'))
+        watcher._queue([Change(MOVED, str(tmp_path / 'a.png'),
+                               str(tmp_path / 'c.txt'), False)])
+        watcher.flush()
+        assert watcher.storage.all() == []
+    finally:
+        watcher.close()
+
+
+def test_watcher_move_into_excluded_directory(tmp_path):
+    (tmp_path / '.git').mkdir()
+    (tmp_path / 'd').mkdir()
+    write(tmp_path / 'a.png')
+    write(tmp_path / 'd' / 'b.png')
+    rules = metags.rules.Rules(
+        [metags.rules.exclude('.git', directory=True)])
+    watcher = make_watcher(tmp_path, pattern=rules, polling=True)
+    try:
+        assert len(watcher.storage.all()) == 2
+        os.rename(str(tmp_path / 'a.png'), str(tmp_path / '.git' / 'a.png'))
+        os.rename(str(tmp_path / 'd'), str(tmp_path / '.git' / 'd'))
+        watcher._queue([
+            Change(MOVED, str(tmp_path / 'a.png'),
+                   str(tmp_path / '.git' / 'a.png'), False),
+            Change(MOVED, str(tmp_path / 'd'),
+                   str(tmp_path / '.git' / 'd'), True),
+        ])
+        watcher.flush()
+        assert watcher.storage.all() == []
+    finally:
+        watcher.close()
+
+
+def test_watcher_ignored_file_does_not_write(tmp_path, monkeypatch):
+    watcher = make_watcher(tmp_path, pattern=r'.*\.png', polling=True)
+    removed = []
+    monkeypatch.setattr(watcher.storage, 'remove', removed.append)
+    try:
+        write(tmp_path / 'a.txt')
+        watcher._queue([Change(CREATED, str(tmp_path / 'a.txt'), None,
+                               False)])
+        watcher.flush()
+        assert removed == []
+    finally:
+        watcher.close()
+
+
+@linux
+def test_watcher_falls_back_to_polling_at_start(tmp_path):
+    (tmp_path / 'd').mkdir()
+    watcher = make_watcher(tmp_path, max_watches=1)
+    try:
+        assert isinstance(watcher.backend, metags.watcher.PollingBackend)
+    finally:
+        watcher.close()
+
+
+@linux
+def test_watcher_falls_back_to_polling_when_tree_grows(tmp_path):
+    watcher = make_watcher(tmp_path, max_watches=2, poll_interval=0)
+    try:
+        assert isinstance(watcher.backend, metags.watcher.InotifyBackend)
+        (tmp_path / 'd').mkdir()
+        (tmp_path / 'd' / 'e').mkdir()
+        write(tmp_path / 'd' / 'e' / 'a')
+        end = time.time() + 5
+        while time.time() < end and \
+                isinstance(watcher.backend, metags.watcher.InotifyBackend):
+            watcher.step(0.1)
+        assert isinstance(watcher.backend, metags.watcher.PollingBackend)
+        watcher.flush()
+        assert [x.url for x in watcher.storage.all()] == \
+            [str(tmp_path / 'd' / 'e' / 'a')]
+    finally:
+        watcher.close()